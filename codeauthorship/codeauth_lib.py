@@ -1,15 +1,65 @@
+import collections
 import csv
 import io
+import multiprocessing
+import os
 import sys
 
 DATA_PATH = "/iesl/canvas/nnayak/data/codeauth_data/gcj-dataset"
 csv.field_size_limit(sys.maxsize)
 
-def file_getter(filename):
+def strip_nulls(f, null):
+  # The csv module rejects NUL bytes, so replace them line by line as the file is read.
+  for line in f:
+    yield line.replace("\0", null)
+
+def file_getter(filename, null="___NULL"):
   # assert year in range(2008, 2019)
   # filename = DATA_PATH + "/gcj" + str(year) + ".csv"
 
+  # Rows are yielded lazily, so memory stays flat regardless of the size of the file.
   with open(filename, 'r') as f:
-    data = f.read().replace("\0", "___NULL")
-    reader = csv.DictReader(data.splitlines())
-    return reader
+    reader = csv.DictReader(strip_nulls(f, null))
+    for row in reader:
+      yield row
+
+def files_getter(filenames, null="___NULL"):
+  # Comma separated list of files, read one after the other.
+  for fn in filenames.split(','):
+    fn = os.path.expanduser(fn)
+    print('reading = {}'.format(fn))
+    for row in file_getter(fn, null=null):
+      yield row
+
+def _map_chunk(func, chunk):
+  return [func(x) for x in chunk]
+
+def map_rows(func, rows, workers=1, chunksize=16):
+  # Apply func to each row, fanning out to a process pool when workers > 1.
+  # Results come back in input order. Only a bounded number of chunks are in
+  # flight at once so that rows are still read lazily. func must be picklable.
+  if workers <= 1:
+    for row in rows:
+      yield func(row)
+    return
+
+  def chunks():
+    chunk = []
+    for row in rows:
+      chunk.append(row)
+      if len(chunk) == chunksize:
+        yield chunk
+        chunk = []
+    if len(chunk) > 0:
+      yield chunk
+
+  with multiprocessing.Pool(workers) as pool:
+    pending = collections.deque()
+    for chunk in chunks():
+      pending.append(pool.apply_async(_map_chunk, (func, chunk)))
+      if len(pending) >= 4 * workers:
+        for x in pending.popleft().get():
+          yield x
+    while len(pending) > 0:
+      for x in pending.popleft().get():
+        yield x
@@ -15,18 +15,14 @@ def main(options):
       for year in range(options.yearstart, options.yearend):
         filenames.append(os.path.join(options.data_path, 'gcj{}.csv'.format(year)))
 
-  # Read files.
-  rows = []
+  # Read files. Rows are printed as they are read so memory stays flat.
   for filename in filenames:
     reader = codeauth_lib.file_getter(filename)
     for row in reader:
       num_chars = str(len(str(row["flines"])))
       row_list = (row["year"], row["round"], row["username"], row["solution"],
           row["full_path"].split(".")[-1], num_chars)
-      rows.append(row_list)
-
-  for row in rows:
-    print("\t".join(row))
+      print("\t".join(row_list))
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
@@ -1,9 +1,7 @@
-from io import BytesIO
-import io
 import os
-import tokenize
 import codeauthorship.codeauth_lib as codeauth_lib
 import argparse
+from codeauthorship.dataset.tokenizing import get_tokenizer
 
 
 def main(options):
@@ -32,8 +30,7 @@ def main(options):
           # These are really hard to tokenize
           continue
         try:
-          g = tokenize.tokenize(BytesIO(file_text.encode('utf-8')).readline)
-          tokens = [tok for _, tok, _, _, _ in g]
+          tokens = [x['val'] for x in get_tokenizer('python').tokenize(file_text)]
           print(row["username"] + "\t" + " ".join(tokens))
         except:
           continue
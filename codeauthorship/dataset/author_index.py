@@ -0,0 +1,145 @@
+"""
+Byte-offset author index for JSONL corpora.
+
+The index is a sidecar file (`<path>.index`) that maps each author to the
+(byte offset, length) of their non-empty records in the corpus, so readers can
+pick eligible authors from the index alone and seek straight to the lines they
+need. It records the size and mtime of the corpus it was built from and is
+rebuilt when those change.
+
+Only plain JSONL corpora can be indexed: compressed corpora are not seekable.
+"""
+
+import json
+import os
+import random
+
+from collections import OrderedDict
+
+from tqdm import tqdm
+
+from codeauthorship.utils.fileio import detect_compression
+
+
+INDEX_VERSION = 1
+
+
+def is_indexable(path):
+    return os.path.isfile(path) and detect_compression(path) is None
+
+
+class AuthorIndex(object):
+    def __init__(self, path, language, authors, size, mtime):
+        super(AuthorIndex, self).__init__()
+        self.path = path
+        self.language = language
+        # author -> list of (offset, length), in file order.
+        self.authors = authors
+        self.size = size
+        self.mtime = mtime
+
+    @staticmethod
+    def index_path(path):
+        return path + '.index'
+
+    @classmethod
+    def build(cls, path, language, show_progress=False):
+        authors = OrderedDict()
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in tqdm(f, desc='index', disable=not show_progress):
+                ex = json.loads(line)
+                # Empty records are skipped by DatasetReader, so they are not indexed.
+                if len(ex['tokens']) > 0:
+                    authors.setdefault(ex['username'], []).append((offset, len(line)))
+                offset += len(line)
+        stat = os.stat(path)
+        return cls(path, language, authors, stat.st_size, stat.st_mtime)
+
+    @classmethod
+    def load(cls, path, language):
+        with open(cls.index_path(path)) as f:
+            data = json.load(f)
+        if data['version'] != INDEX_VERSION:
+            return None
+        stat = os.stat(path)
+        if data['size'] != stat.st_size or data['mtime'] != stat.st_mtime:
+            return None
+        authors = OrderedDict((k, [tuple(x) for x in v]) for k, v in data['authors'])
+        return cls(path, language, authors, data['size'], data['mtime'])
+
+    @classmethod
+    def load_or_build(cls, path, language, show_progress=False):
+        index = None
+        if os.path.exists(cls.index_path(path)):
+            index = cls.load(path, language)
+        if index is None:
+            index = cls.build(path, language, show_progress=show_progress)
+            index.save()
+        return index
+
+    def save(self):
+        data = {}
+        data['version'] = INDEX_VERSION
+        data['language'] = self.language
+        data['size'] = self.size
+        data['mtime'] = self.mtime
+        data['counts'] = {k: len(v) for k, v in self.authors.items()}
+        data['authors'] = list(self.authors.items())
+        with open(self.index_path(self.path), 'w') as f:
+            json.dump(data, f)
+
+    def counts(self):
+        return {k: len(v) for k, v in self.authors.items()}
+
+    def read(self, authors, projection=None):
+        """
+        Read the records of the given authors, in file order, optionally
+        projecting them (see reading.TokenProjection).
+        """
+        entries = []
+        for author in authors:
+            entries += self.authors.get(author, [])
+        entries.sort()
+
+        with open(self.path, 'rb') as f:
+            for offset, length in entries:
+                f.seek(offset)
+                line = f.read(length)
+                if projection is not None:
+                    yield projection.parse_line(line.decode('utf-8'))
+                else:
+                    yield json.loads(line)
+
+
+def select_authors(indexes, options, files_per_author=9):
+    """
+    Choose authors using only the indexes, with the same eligibility rules as
+    DatasetManager.balance_data: at least (or with --exact, exactly)
+    `files_per_author` files, files in more than one language for --multilang,
+    and at most --max_classes authors chosen at random.
+    """
+    author_counts = OrderedDict()
+    author_languages = {}
+    for index in indexes:
+        for author, count in index.counts().items():
+            author_counts[author] = author_counts.get(author, 0) + count
+            author_languages.setdefault(author, set()).add(index.language)
+
+    eligible = []
+    for author, count in author_counts.items():
+        if options.exact:
+            if count != files_per_author:
+                continue
+        else:
+            if count < files_per_author:
+                continue
+        if options.multilang and len(author_languages[author]) == 1:
+            continue
+        eligible.append(author)
+
+    random.shuffle(eligible)
+    if options.max_classes is not None:
+        eligible = eligible[:options.max_classes]
+
+    return set(eligible), len(author_counts)
@@ -0,0 +1,69 @@
+"""
+Token-by-author incidence.
+
+`AuthorUsage` holds a sparse (n_tokens x n_authors) matrix of how many times
+each author uses each token, built in one pass over the token ids. The number
+of authors that use each token is computed once from it, so every
+--author_usage / --minthreshold_author threshold and every usage report is a
+lookup.
+"""
+
+from array import array
+
+import numpy as np
+
+from scipy import sparse
+
+from codeauthorship.dataset.encoding import Vocab
+
+
+class AuthorUsage(object):
+    def __init__(self, counts):
+        super(AuthorUsage, self).__init__()
+        # Converting to CSR sums duplicate (token, author) entries, so each
+        # stored entry of a row is one author that uses the token.
+        self.counts = sparse.csr_matrix(counts)
+        self.authors_per_token = np.diff(self.counts.indptr)
+
+    @classmethod
+    def build(cls, token_ids, author_ids, n_tokens, n_authors):
+        data = np.ones(len(token_ids), dtype=np.int32)
+        counts = sparse.coo_matrix((data, (token_ids, author_ids)), shape=(n_tokens, n_authors))
+        return cls(counts)
+
+    @classmethod
+    def from_sequences(cls, seq, labels, n_tokens):
+        """
+        From a TokenSequences and one label index per file.
+        """
+        n_authors = int(labels.max()) + 1 if len(labels) > 0 else 0
+        return cls.build(seq.token_ids, np.repeat(labels, seq.lengths()), n_tokens, n_authors)
+
+    @classmethod
+    def from_lists(cls, seqs, labels):
+        """
+        From a list of token strings and one author per file. Returns the usage
+        and the Vocab its token ids refer to.
+        """
+        vocab = Vocab()
+        author_vocab = Vocab()
+        token_ids = array('i')
+        author_ids = array('i')
+        for xs, label in zip(seqs, labels):
+            token_ids.extend(vocab.encode(xs))
+            author_ids.extend([author_vocab.intern(label)] * len(xs))
+        usage = cls.build(np.frombuffer(token_ids, dtype=np.int32), np.frombuffer(author_ids, dtype=np.int32),
+                          len(vocab), len(author_vocab))
+        return usage, vocab
+
+    def usage(self, token_id):
+        return int(self.authors_per_token[token_id])
+
+    def keep(self, threshold):
+        """
+        Boolean table over token ids: used by at least `threshold` authors.
+        """
+        return self.authors_per_token >= threshold
+
+    def token_counts(self):
+        return np.asarray(self.counts.sum(axis=1)).ravel()
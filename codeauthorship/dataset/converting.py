@@ -0,0 +1,276 @@
+"""
+Convert GCJ CSV dumps into JSONL token corpora.
+
+header:
+,year,round,username,task,solution,file,full_path,flines
+
+Incremental builds keep a manifest next to each corpus (`<path_out>.manifest`).
+Every row is keyed by (year, round, username, task, solution, file, content
+hash) and rows are committed in batches of BATCH_SIZE: a batch's corpus lines
+are flushed to disk before the manifest line that records them. A re-run
+truncates the corpus to the last committed batch, skips rows already in the
+manifest, and appends the rest.
+
+A corpus is only resumed from its manifest. An existing corpus without one, or
+an input row whose content changed since it was committed, raises a ValueError;
+rebuild the corpus without `incremental` in either case.
+"""
+
+import functools
+import hashlib
+import json
+import os
+
+from collections import Counter
+
+import codeauthorship.codeauth_lib as codeauth_lib
+
+from codeauthorship.dataset.tokenizing import get_tokenizer
+from codeauthorship.utils.fileio import compression_from_extension, wrap_compressed
+
+
+# Rows per manifest commit.
+BATCH_SIZE = 1000
+
+
+def get_row_key(row):
+    content_hash = hashlib.sha1(row['flines'].encode('utf-8', 'surrogatepass')).hexdigest()
+    return (row['year'], row['round'], row['username'], row['task'], row['solution'], row['file'], content_hash)
+
+
+def get_row_identity(key):
+    # A row's key without its content hash.
+    return key[:-1]
+
+
+class Manifest(object):
+    def __init__(self, path):
+        super(Manifest, self).__init__()
+        self.path = path
+
+        # Number of committed occurrences of each key. Identical rows may
+        # appear more than once in the input, so occurrences are counted.
+        self.seen = Counter()
+        self.identities = Counter()
+        self.end = 0
+        self.example_id = 0
+
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    # Torn write from an interrupted run. Everything after it is uncommitted.
+                    break
+                self.update(batch['keys'])
+                self.end = batch['end']
+                self.example_id = batch['example_id']
+
+    def commit(self, end, example_id, keys):
+        batch = dict(end=end, example_id=example_id, keys=keys)
+        with open(self.path, 'a') as f:
+            f.write('{}\n'.format(json.dumps(batch)))
+            f.flush()
+            os.fsync(f.fileno())
+        self.update(keys)
+        self.end = end
+        self.example_id = example_id
+
+    def update(self, keys):
+        keys = [tuple(x) for x in keys]
+        self.seen.update(keys)
+        self.identities.update([get_row_identity(x) for x in keys])
+
+
+class CorpusOutput(object):
+    """
+    A JSONL corpus being written for one language. With `incremental`, the
+    corpus is resumed from its manifest instead of being overwritten.
+
+    The corpus is compressed if its path ends in .gz, .bz2, .xz or .lzma.
+    Lines are buffered and written in bulk. For incremental builds each
+    committed batch ends its compressed stream, so the committed offset is
+    always the end of a complete stream and later batches are appended as
+    new streams.
+    """
+
+    def __init__(self, path, incremental=False, buffer_size=256):
+        super(CorpusOutput, self).__init__()
+        self.path = path
+        self.compression = compression_from_extension(path)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.manifest = None
+        self.example_id = 0
+        self.pending = []
+
+        self.failed = 0
+        self.success = 0
+        self.resumed = 0
+
+        if incremental:
+            if not os.path.exists(path + '.manifest') and os.path.exists(path) and os.path.getsize(path) > 0:
+                raise ValueError('{} has no manifest and can not be resumed. Rebuild it without '
+                                 '--incremental.'.format(path))
+            self.manifest = Manifest(path + '.manifest')
+            self.example_id = self.manifest.example_id
+            # Drop anything written after the last committed batch.
+            with open(path, 'ab') as f:
+                f.truncate(self.manifest.end)
+            self.raw = open(path, 'ab')
+        else:
+            self.raw = open(path, 'wb')
+        self.f = self.open_stream()
+
+    def open_stream(self):
+        if self.compression is None:
+            return self.raw
+        return wrap_compressed(self.raw, self.compression, 'wb')
+
+    def close_stream(self):
+        if self.f is not self.raw:
+            self.f.close()
+
+    def is_committed(self, key, occurrence):
+        return self.manifest is not None and occurrence <= self.manifest.seen[key]
+
+    def is_changed(self, key, occurrence):
+        # `occurrence` counts rows with this key's identity. A row is changed if
+        # the same occurrence of its identity was committed with other content.
+        return self.manifest is not None and occurrence <= self.manifest.identities[get_row_identity(key)]
+
+    def write(self, key, year, username, tokens):
+        if tokens is None:
+            self.failed += 1
+        else:
+            ex = {}
+            ex['year'] = year
+            ex['username'] = username
+            ex['tokens'] = tokens
+            ex['example_id'] = str(self.example_id)
+
+            self.buffer.append('{}\n'.format(json.dumps(ex)))
+            if len(self.buffer) >= self.buffer_size:
+                self.flush_buffer()
+            self.example_id += 1
+            self.success += 1
+
+        if self.manifest is not None:
+            self.pending.append(key)
+
+    def flush_buffer(self):
+        if len(self.buffer) > 0:
+            self.f.write(''.join(self.buffer).encode('utf-8'))
+            self.buffer = []
+
+    def commit(self):
+        if self.manifest is None or len(self.pending) == 0:
+            return
+        self.flush_buffer()
+        self.close_stream()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.manifest.commit(self.raw.tell(), self.example_id, self.pending)
+        self.pending = []
+        self.f = self.open_stream()
+
+    def close(self):
+        self.commit()
+        self.flush_buffer()
+        self.close_stream()
+        self.raw.close()
+
+
+def tokenize_row(task, lex_only=False):
+    """
+    Tokenize a single (language, key, row) task. Runs in a worker process when
+    workers > 1. The tokens are None if the row failed to tokenize.
+    """
+    language, key, row = task
+
+    tokens = None
+    try:
+        tokens = get_tokenizer(language, lex_only=lex_only).tokenize(row['flines'])
+    except:
+        pass
+
+    return language, key, row['year'], row['username'], tokens
+
+
+def convert_files(path_in, paths_out, workers=1, lex_only=False, incremental=False):
+    """
+    Read each CSV in `path_in` once, routing every row by file extension to
+    the tokenizer for its language and writing one corpus per language.
+
+    paths_out: dict from language to output path.
+
+    Returns the number of skipped rows and the CorpusOutput for each language,
+    which holds its failed/success/resumed counts.
+    """
+    reader = codeauth_lib.files_getter(path_in, null='')
+    tokenizers = [get_tokenizer(language) for language in paths_out.keys()]
+
+    skipped = 0
+    occurrences = Counter()
+    identities = Counter()
+
+    outputs = {language: CorpusOutput(path, incremental=incremental)
+               for language, path in paths_out.items()}
+
+    def routed_rows():
+        nonlocal skipped
+        for row in reader:
+            # Filtered here so that skipped rows are never sent to workers.
+            for tokenizer in tokenizers:
+                if tokenizer.accepts(row['file']):
+                    break
+            else:
+                skipped += 1
+                continue
+
+            language = tokenizer.language
+            key = None
+            if incremental:
+                key = get_row_key(row)
+                occurrences[key] += 1
+                identities[get_row_identity(key)] += 1
+                if outputs[language].is_committed(key, occurrences[key]):
+                    outputs[language].resumed += 1
+                    continue
+                if outputs[language].is_changed(key, identities[get_row_identity(key)]):
+                    raise ValueError('{} changed since it was added to {}. Rebuild it without '
+                                     '--incremental.'.format(row['full_path'], outputs[language].path))
+
+            yield language, key, row
+
+    # Results come back in input order, so example ids are the same for any number of workers.
+    func = functools.partial(tokenize_row, lex_only=lex_only)
+    results = codeauth_lib.map_rows(func, routed_rows(), workers=workers)
+
+    try:
+        for i, (language, key, year, username, tokens) in enumerate(results):
+            outputs[language].write(key, year, username, tokens)
+
+            if (i + 1) % BATCH_SIZE == 0:
+                for output in outputs.values():
+                    output.commit()
+    finally:
+        for output in outputs.values():
+            output.close()
+
+    return skipped, outputs
+
+
+def convert_file(path_in, path_out, language, workers=1, lex_only=False, incremental=False):
+    skipped, outputs = convert_files(path_in, {language: path_out}, workers=workers,
+                                     lex_only=lex_only, incremental=incremental)
+
+    print('skipped', skipped)
+    print('failed', outputs[language].failed)
+    print('success', outputs[language].success)
+    if incremental:
+        print('resumed', outputs[language].resumed)
@@ -0,0 +1,373 @@
+"""
+Binary token corpus.
+
+A corpus is a directory (by convention named `*.corpus`) with:
+
+    meta.json        - sizes, token types, and authors.
+    vocab.json       - interned token values. token_ids index into this list.
+    token_ids.bin    - int32, one entry per token.
+    type_ids.bin     - uint8, one entry per token. Indexes into meta['types'].
+    offsets.bin      - int64, n_files + 1 entries. File i is tokens offsets[i]:offsets[i+1].
+    author_ids.bin   - int32, one entry per file. Indexes into meta['authors'].
+    years.bin        - int16, one entry per file.
+    example_ids.bin  - int64, one entry per file.
+
+Arrays are opened with `np.memmap`, so opening a corpus only reads the
+vocabularies. Use `make_dataset_binary.py` to convert an existing JSONL corpus.
+"""
+
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import threading
+
+import numpy as np
+
+from codeauthorship.utils.fileio import open_file
+
+
+CORPUS_VERSION = 1
+
+TOKEN_DTYPE = np.int32
+TYPE_DTYPE = np.uint8
+OFFSET_DTYPE = np.int64
+AUTHOR_DTYPE = np.int32
+YEAR_DTYPE = np.int16
+EXAMPLE_ID_DTYPE = np.int64
+
+
+def is_corpus(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def read_jsonl(path, projection=None):
+    # Compressed corpora are decompressed as they are read.
+    with open_file(path) as f:
+        for line in f:
+            if projection is not None:
+                yield projection.parse_line(line)
+            else:
+                yield json.loads(line)
+
+
+# Set in each worker of read_jsonl_pipelined, so it is pickled once per worker.
+_worker_projection = None
+
+
+def _init_worker(projection):
+    global _worker_projection
+    _worker_projection = projection
+
+
+def _parse_lines(lines):
+    """
+    Decode a chunk of lines in a worker. Empty records are dropped here, so
+    they are never sent back.
+    """
+    if _worker_projection is None:
+        return [json.loads(line) for line in lines]
+    records = [_worker_projection.parse_line(line) for line in lines]
+    return [ex for ex in records if not ex['empty']]
+
+
+def _read_chunks(path, chunk_size, chunks, stop):
+    """
+    Reader thread: put lists of `chunk_size` raw lines on the bounded `chunks`
+    queue, then None. An error is put on the queue for the consumer to raise.
+    """
+    def put(x):
+        while not stop.is_set():
+            try:
+                chunks.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        with open_file(path) as f:
+            chunk = []
+            for line in f:
+                chunk.append(line)
+                if len(chunk) == chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if len(chunk) > 0 and not put(chunk):
+                return
+    except Exception as e:
+        put(e)
+        return
+    put(None)
+
+
+def read_jsonl_pipelined(path, projection=None, workers=2, chunk_size=64, max_in_flight=1024):
+    """
+    read_jsonl with I/O, decoding and the consumer overlapped. A reader
+    thread pulls raw line chunks, a pool of `workers` processes decodes and
+    projects them, and records are yielded in file order. Both stages are
+    bounded, so at most about `max_in_flight` records are read but not yet
+    consumed.
+    """
+    max_chunks = max(1, max_in_flight // chunk_size)
+    # The reader only needs to stay a chunk or two ahead of the pool.
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    try:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(projection,)) as pool:
+            # Started once the workers are forked, so no fork copies the reader mid-read.
+            reader = threading.Thread(target=_read_chunks, args=(path, chunk_size, chunks, stop), daemon=True)
+            reader.start()
+
+            pending = collections.deque()
+            done = False
+            while not done or len(pending) > 0:
+                # Keep the workers busy, up to the in-flight limit.
+                while not done and len(pending) < max_chunks:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        done = True
+                    elif isinstance(chunk, Exception):
+                        raise chunk
+                    else:
+                        pending.append(pool.apply_async(_parse_lines, (chunk,)))
+                if len(pending) > 0:
+                    for ex in pending.popleft().get():
+                        yield ex
+    finally:
+        stop.set()
+
+
+def iter_records(path, projection=None):
+    """
+    Yield records in the JSONL layout (year, username, tokens, example_id)
+    from either a JSONL file or a binary corpus. With a projection (see
+    reading.TokenProjection), records hold the projected `types` and `vals`.
+    """
+    if is_corpus(path):
+        return TokenCorpus(path).records(projection)
+    return read_jsonl(path, projection)
+
+
+def to_columns(ex, keep_types=None):
+    tokens = ex['tokens']
+    if keep_types is not None:
+        tokens = [x for x in tokens if x['type'] in keep_types]
+    rec = {k: v for k, v in ex.items() if k != 'tokens'}
+    rec['types'] = [x['type'] for x in tokens]
+    rec['vals'] = [x['val'] for x in tokens]
+    return rec
+
+
+def iter_columns(path, keep_types=None):
+    """
+    iter_records with parallel `types` and `vals` lists in place of the
+    per-token dicts, optionally only for the tokens of `keep_types`. Binary
+    corpora are read from their id arrays (see TokenCorpus.columns).
+    """
+    if is_corpus(path):
+        return TokenCorpus(path).columns(keep_types)
+    return (to_columns(ex, keep_types) for ex in read_jsonl(path))
+
+
+class CorpusWriter(object):
+    """
+    Streams records into a binary corpus. Only the vocabularies are kept in
+    memory, token arrays are appended to disk as each record is added.
+    """
+
+    def __init__(self, path):
+        super(CorpusWriter, self).__init__()
+        self.path = path
+
+        os.makedirs(path, exist_ok=True)
+        # The arrays below are rewritten, so an earlier corpus here is no longer valid.
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            os.remove(os.path.join(path, 'meta.json'))
+
+        self.token2idx = {}
+        self.type2idx = {}
+        self.author2idx = {}
+        self.n_tokens = 0
+        self.n_files = 0
+
+        self.f_token_ids = open(os.path.join(path, 'token_ids.bin'), 'wb')
+        self.f_type_ids = open(os.path.join(path, 'type_ids.bin'), 'wb')
+        self.f_offsets = open(os.path.join(path, 'offsets.bin'), 'wb')
+        self.f_author_ids = open(os.path.join(path, 'author_ids.bin'), 'wb')
+        self.f_years = open(os.path.join(path, 'years.bin'), 'wb')
+        self.f_example_ids = open(os.path.join(path, 'example_ids.bin'), 'wb')
+
+        self.f_offsets.write(np.array([0], dtype=OFFSET_DTYPE).tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+    def intern(self, mapping, value):
+        idx = mapping.get(value)
+        if idx is None:
+            idx = mapping[value] = len(mapping)
+        return idx
+
+    def add(self, ex):
+        token_ids = [self.intern(self.token2idx, x['val']) for x in ex['tokens']]
+        type_ids = [self.intern(self.type2idx, x['type']) for x in ex['tokens']]
+        assert len(self.type2idx) <= np.iinfo(TYPE_DTYPE).max + 1, 'too many token types'
+
+        self.n_tokens += len(token_ids)
+        self.n_files += 1
+
+        self.f_token_ids.write(np.array(token_ids, dtype=TOKEN_DTYPE).tobytes())
+        self.f_type_ids.write(np.array(type_ids, dtype=TYPE_DTYPE).tobytes())
+        self.f_offsets.write(np.array([self.n_tokens], dtype=OFFSET_DTYPE).tobytes())
+        self.f_author_ids.write(np.array([self.intern(self.author2idx, ex['username'])], dtype=AUTHOR_DTYPE).tobytes())
+        self.f_years.write(np.array([int(ex['year'])], dtype=YEAR_DTYPE).tobytes())
+        self.f_example_ids.write(np.array([int(ex['example_id'])], dtype=EXAMPLE_ID_DTYPE).tobytes())
+
+    def close(self, complete=True):
+        """
+        Closes the arrays, and with `complete` writes the vocabulary and
+        metadata that make the corpus readable.
+        """
+        for f in (self.f_token_ids, self.f_type_ids, self.f_offsets,
+                  self.f_author_ids, self.f_years, self.f_example_ids):
+            f.close()
+
+        if not complete:
+            return
+
+        def by_index(mapping):
+            return [k for k, v in sorted(mapping.items(), key=lambda x: x[1])]
+
+        with open(os.path.join(self.path, 'vocab.json'), 'w') as f:
+            json.dump(by_index(self.token2idx), f)
+
+        meta = {}
+        meta['version'] = CORPUS_VERSION
+        meta['n_files'] = self.n_files
+        meta['n_tokens'] = self.n_tokens
+        meta['types'] = by_index(self.type2idx)
+        meta['authors'] = by_index(self.author2idx)
+
+        # Written last so that a partially written corpus is never opened.
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class TokenCorpus(object):
+    def __init__(self, path):
+        super(TokenCorpus, self).__init__()
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        assert meta['version'] == CORPUS_VERSION, 'unsupported corpus version {}'.format(meta['version'])
+
+        with open(os.path.join(path, 'vocab.json')) as f:
+            self.vocab = json.load(f)
+
+        self.types = meta['types']
+        self.authors = meta['authors']
+        self.n_files = meta['n_files']
+        self.n_tokens = meta['n_tokens']
+
+        self.token_ids = self.memmap('token_ids.bin', TOKEN_DTYPE, self.n_tokens)
+        self.type_ids = self.memmap('type_ids.bin', TYPE_DTYPE, self.n_tokens)
+        self.offsets = self.memmap('offsets.bin', OFFSET_DTYPE, self.n_files + 1)
+        self.author_ids = self.memmap('author_ids.bin', AUTHOR_DTYPE, self.n_files)
+        self.years = self.memmap('years.bin', YEAR_DTYPE, self.n_files)
+        self.example_ids = self.memmap('example_ids.bin', EXAMPLE_ID_DTYPE, self.n_files)
+
+    def memmap(self, name, dtype, size):
+        # np.memmap refuses to map empty files.
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(size,))
+
+    def __len__(self):
+        return self.n_files
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def token_slice(self, i):
+        return slice(int(self.offsets[i]), int(self.offsets[i+1]))
+
+    def tokens(self, i):
+        s = self.token_slice(i)
+        vocab, types = self.vocab, self.types
+        return [{'type': types[tt], 'val': vocab[t]}
+                for t, tt in zip(self.token_ids[s].tolist(), self.type_ids[s].tolist())]
+
+    def record(self, i):
+        ex = {}
+        ex['year'] = str(self.years[i])
+        ex['username'] = self.authors[self.author_ids[i]]
+        ex['tokens'] = self.tokens(i)
+        ex['example_id'] = str(self.example_ids[i])
+        return ex
+
+    def records(self, projection=None):
+        if projection is None:
+            for i in range(self.n_files):
+                yield self.record(i)
+            return
+
+        # Masks over the type and token vocabularies, so rejected tokens are
+        # dropped from the id arrays before any string is looked up.
+        type_mask = np.array([projection.keep_type(x) for x in self.types], dtype=bool)
+        val_mask = None
+        if projection.reserved or projection.notreserved:
+            val_mask = np.array([projection.keep_val(x) for x in self.vocab], dtype=bool)
+        vocab = [projection.normalize(x) for x in self.vocab] if projection.lowercase else self.vocab
+        types = self.types
+
+        for i in range(self.n_files):
+            s = self.token_slice(i)
+            token_ids = self.token_ids[s]
+            type_ids = self.type_ids[s]
+            keep = type_mask[type_ids]
+            if val_mask is not None:
+                keep &= val_mask[token_ids]
+
+            ex = {}
+            ex['year'] = str(self.years[i])
+            ex['username'] = self.authors[self.author_ids[i]]
+            ex['example_id'] = str(self.example_ids[i])
+            ex['empty'] = len(token_ids) == 0
+            ex['types'] = [types[x] for x in type_ids[keep].tolist()]
+            ex['vals'] = [vocab[x] for x in token_ids[keep].tolist()]
+            yield ex
+
+    def columns(self, keep_types=None):
+        """
+        Records with parallel `types` and `vals` lists, looked up straight from
+        the id arrays. With `keep_types`, tokens of other types are dropped by
+        a mask over the type vocabulary before any value is looked up.
+        """
+        type_mask = None
+        if keep_types is not None:
+            type_mask = np.array([x in keep_types for x in self.types], dtype=bool)
+        vocab, types = self.vocab, self.types
+
+        for i in range(self.n_files):
+            s = self.token_slice(i)
+            token_ids = self.token_ids[s]
+            type_ids = self.type_ids[s]
+            if type_mask is not None:
+                keep = type_mask[type_ids]
+                token_ids, type_ids = token_ids[keep], type_ids[keep]
+
+            ex = {}
+            ex['year'] = str(self.years[i])
+            ex['username'] = self.authors[self.author_ids[i]]
+            ex['types'] = [types[x] for x in type_ids.tolist()]
+            ex['vals'] = [vocab[x] for x in token_ids.tolist()]
+            ex['example_id'] = str(self.example_ids[i])
+            yield ex
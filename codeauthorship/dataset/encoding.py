@@ -0,0 +1,167 @@
+"""
+Integer-encoded token sequences.
+
+Datasets hold token values as ids into a `Vocab` shared by every language, so
+each distinct string is stored once. The sequences of a dataset are kept in
+`TokenSequences`, the in-memory counterpart of the binary corpus layout (see
+corpus.py): flat token ids, flat type ids, and offsets where file i is tokens
+offsets[i]:offsets[i+1]. Type ids are None for sequences built without types.
+"""
+
+from array import array
+
+import numpy as np
+
+
+TOKEN_DTYPE = np.int32
+TYPE_DTYPE = np.uint8
+OFFSET_DTYPE = np.int64
+
+
+class VocabIndex(dict):
+    """
+    value -> id. Looking up a missing value interns it, so encoding stays a
+    single C-level lookup per token.
+    """
+
+    def __init__(self, values):
+        super(VocabIndex, self).__init__()
+        self.values = values
+
+    def __missing__(self, value):
+        idx = self[value] = len(self.values)
+        self.values.append(value)
+        return idx
+
+
+class Vocab(object):
+    def __init__(self, values=()):
+        super(Vocab, self).__init__()
+        self.values = []
+        self.value2idx = VocabIndex(self.values)
+        self.encode(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def intern(self, value):
+        return self.value2idx[value]
+
+    def encode(self, values):
+        return list(map(self.value2idx.__getitem__, values))
+
+
+class SequenceBuilder(object):
+    """
+    Appends sequences without keeping a Python list per file.
+    """
+
+    def __init__(self, vocab, type_vocab=None):
+        super(SequenceBuilder, self).__init__()
+        self.vocab = vocab
+        self.type_vocab = type_vocab
+        self.token_ids = array('i')
+        self.type_ids = array('B') if type_vocab is not None else None
+        self.offsets = array('q', [0])
+
+    def add(self, vals, types=None):
+        self.token_ids.extend(self.vocab.encode(vals))
+        if self.type_vocab is not None:
+            self.type_ids.extend(self.type_vocab.encode(types))
+            assert len(self.type_vocab) <= np.iinfo(TYPE_DTYPE).max + 1, 'too many token types'
+        self.offsets.append(len(self.token_ids))
+
+    def build(self):
+        type_ids = None
+        if self.type_ids is not None:
+            type_ids = np.frombuffer(self.type_ids, dtype=TYPE_DTYPE)
+        return TokenSequences(
+            np.frombuffer(self.token_ids, dtype=TOKEN_DTYPE),
+            type_ids,
+            np.frombuffer(self.offsets, dtype=OFFSET_DTYPE))
+
+
+def gather(arr, index):
+    return None if arr is None else arr[index]
+
+
+class TokenSequences(object):
+    def __init__(self, token_ids, type_ids, offsets):
+        super(TokenSequences, self).__init__()
+        self.token_ids = token_ids
+        self.type_ids = type_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.token_ids[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def types(self, i):
+        return self.type_ids[self.offsets[i]:self.offsets[i+1]]
+
+    def filter(self, keep):
+        """
+        Keep the tokens where the boolean mask `keep` is True, in one pass over
+        the flat arrays. Every file keeps its position, possibly empty.
+        """
+        kept = np.zeros(len(keep) + 1, dtype=OFFSET_DTYPE)
+        np.cumsum(keep, out=kept[1:])
+        return TokenSequences(self.token_ids[keep], gather(self.type_ids, keep), kept[self.offsets])
+
+    def map_tokens(self, lookup):
+        return TokenSequences(lookup[self.token_ids], self.type_ids, self.offsets)
+
+    def take(self, index):
+        """
+        Gather the files in `index`, in that order, into new flat arrays.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        lengths = self.lengths()[index]
+        offsets = np.zeros(len(index) + 1, dtype=OFFSET_DTYPE)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of every gathered token in the source arrays.
+        positions = np.repeat(self.offsets[:-1][index] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return TokenSequences(self.token_ids[positions], gather(self.type_ids, positions), offsets)
+
+    @staticmethod
+    def concatenate(seqs):
+        offsets = [np.zeros(1, dtype=OFFSET_DTYPE)]
+        total = 0
+        for x in seqs:
+            offsets.append(x.offsets[1:] + total)
+            total += x.offsets[-1]
+        type_ids = None
+        if all([x.type_ids is not None for x in seqs]):
+            type_ids = np.concatenate([x.type_ids for x in seqs]).astype(TYPE_DTYPE, copy=False)
+        return TokenSequences(
+            np.concatenate([x.token_ids for x in seqs]).astype(TOKEN_DTYPE, copy=False),
+            type_ids,
+            np.concatenate(offsets))
+
+    @staticmethod
+    def take_from(seqs, index):
+        """
+        Gather files by their position in the concatenation of `seqs`, without
+        building the concatenation: only the gathered files are copied.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        if len(seqs) == 1:
+            return seqs[0].take(index)
+        starts = np.cumsum([0] + [len(x) for x in seqs])
+        source = np.searchsorted(starts, index, side='right') - 1
+        # Gather from each source in turn, then put the files back in order.
+        order = np.argsort(source, kind='stable')
+        parts = [x.take(index[order][source[order] == i] - starts[i]) for i, x in enumerate(seqs)]
+        return TokenSequences.concatenate(parts).take(np.argsort(order))
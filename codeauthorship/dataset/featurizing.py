@@ -0,0 +1,345 @@
+"""
+Vectorizers over integer-encoded token sequences (see encoding.py).
+
+`TokenTfidfVectorizer` builds the count matrix straight from the token ids,
+without joining the tokens into strings. Each vocab entry is mapped once to
+the terms it contributes, the flat id array is expanded to term ids, and the
+term ids of each file become one CSR row. By default the terms are those of
+sklearn's default analyzer (lowercased words of 2+ characters), so the features
+are the same as `TfidfVectorizer` over the space-joined tokens. With `exact`,
+every token is its own term, so operators and single characters are kept.
+
+The matrix is built in two passes over the chunks. The first keeps only arrays
+over the terms (document frequency, total count, first occurrence) and picks
+the `max_features` vocabulary from them; the second writes the TF-IDF rows
+straight into arrays of the final size, optionally memory-mapped. Peak memory
+is the output plus one chunk, never a second copy of the corpus.
+
+`TokenHashingVectorizer` hashes token n-grams and token-type n-grams (e.g.
+NAME,OP) into a fixed number of columns, so it keeps no n-gram vocabulary and
+its memory does not grow with the number of distinct n-grams.
+"""
+
+import os
+
+from array import array
+
+import numpy as np
+
+from scipy import sparse
+
+from sklearn.feature_extraction.text import TfidfTransformer, TfidfVectorizer
+from sklearn.utils import murmurhash3_32
+
+from codeauthorship.dataset.encoding import Vocab
+
+
+# Multiplier for combining the hashes of an n-gram (the 64-bit FNV prime).
+HASH_PRIME = np.uint64(0x100000001b3)
+
+
+def iter_chunks(offsets, chunk_size):
+    """
+    Yields (start, end) file ranges of about `chunk_size` tokens each. A file
+    longer than that is a chunk of its own.
+    """
+    n = len(offsets) - 1
+    start = 0
+    while start < n:
+        end = np.searchsorted(offsets, offsets[start] + chunk_size, side='right') - 1
+        end = min(max(end, start + 1), n)
+        yield start, end
+        start = end
+
+
+class TokenTfidfVectorizer(object):
+    def __init__(self, vocab, max_features=None, exact=False, chunk_size=1 << 18, out_dir=None):
+        super(TokenTfidfVectorizer, self).__init__()
+        self.vocab = vocab
+        self.max_features = max_features
+        self.exact = exact
+        self.chunk_size = chunk_size
+        self.out_dir = out_dir
+        self.vocabulary_ = None
+        self.idf_ = None
+
+    def get_terms(self):
+        """
+        Returns (indptr, term_ids, terms): the terms of vocab entry i are
+        term_ids[indptr[i]:indptr[i+1]], which index into `terms`.
+        """
+        if self.exact:
+            n = len(self.vocab)
+            return np.arange(n + 1), np.arange(n, dtype=np.int32), self.vocab.values
+
+        analyze = TfidfVectorizer().build_analyzer()
+        term_vocab = Vocab()
+        indptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        term_ids = array('i')
+        for i, x in enumerate(self.vocab.values):
+            term_ids.extend(term_vocab.encode(analyze(x)))
+            indptr[i+1] = len(term_ids)
+        return indptr, np.frombuffer(term_ids, dtype=np.int32), term_vocab.values
+
+    def count_chunk(self, token_ids, offsets, indptr, term_ids, n_terms):
+        if self.exact:
+            row_ptr = offsets
+            cols = token_ids
+        else:
+            # Expand every token to its terms, as TokenSequences.take does for files.
+            lengths = np.diff(indptr)[token_ids]
+            term_offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=term_offsets[1:])
+            positions = np.repeat(indptr[token_ids] - term_offsets[:-1], lengths) + np.arange(term_offsets[-1])
+            row_ptr = term_offsets[offsets]
+            cols = term_ids[positions]
+
+        # sum_duplicates sorts the indices in place, so they are a copy: `cols`
+        # keeps the file order (and in exact mode is the caller's token ids).
+        data = np.ones(len(cols), dtype=np.int32)
+        counts = sparse.csr_matrix((data, cols.copy(), row_ptr), shape=(len(offsets) - 1, n_terms))
+        counts.sum_duplicates()
+        # float64, the dtype TfidfVectorizer counts in.
+        return counts.astype(np.float64), cols
+
+    def iter_counts(self, seqs, indptr, term_ids, n_terms):
+        """
+        Yields the term counts of each chunk of files as a CSR matrix, with the
+        term ids of the chunk in file order.
+        """
+        offsets = seqs.offsets
+        for start, end in iter_chunks(offsets, self.chunk_size):
+            token_ids = seqs.token_ids[offsets[start]:offsets[end]]
+            yield self.count_chunk(token_ids, offsets[start:end+1] - offsets[start], indptr, term_ids, n_terms)
+
+    def fit(self, seqs):
+        """
+        First pass: document frequency and total count of every term, and the
+        order the terms first occur in. Only arrays over the terms are kept, so
+        memory is bounded by the vocab and the chunk size.
+        """
+        indptr, term_ids, terms = self.get_terms()
+        n_terms = len(terms)
+        df = np.zeros(n_terms, dtype=np.int64)
+        tfs = np.zeros(n_terms, dtype=np.float64)
+        seen = []
+        is_seen = np.zeros(n_terms, dtype=bool)
+        for counts, cols in self.iter_counts(seqs, indptr, term_ids, n_terms):
+            df += np.bincount(counts.indices, minlength=n_terms)
+            tfs += np.bincount(counts.indices, weights=counts.data, minlength=n_terms)
+
+            new, first = np.unique(cols, return_index=True)
+            new, first = new[~is_seen[new]], first[~is_seen[new]]
+            is_seen[new] = True
+            seen.append(new[np.argsort(first)])
+        seen = np.concatenate(seen) if len(seen) > 0 else np.zeros(0, dtype=np.int64)
+
+        # CountVectorizer numbers the columns in the order terms first occur,
+        # sorts each row, then renumbers the columns by term without
+        # re-sorting. Keeping that layout makes the l2 norms sum in the same
+        # order, so the values match TfidfVectorizer exactly.
+        rank = np.full(n_terms, -1, dtype=np.int64)
+        rank[seen] = np.arange(len(seen))
+        seen_terms = [terms[i] for i in seen.tolist()]
+        map_index = np.zeros(len(seen), dtype=np.int64)
+        map_index[sorted(range(len(seen)), key=lambda i: seen_terms[i])] = np.arange(len(seen))
+
+        # Sorted column -> output column, -1 for terms cut by max_features.
+        new_index = np.arange(len(seen))
+        if self.max_features is not None and len(seen) > self.max_features:
+            column_tfs = np.zeros(len(seen), dtype=np.float64)
+            column_tfs[map_index] = tfs[seen]
+            mask = np.zeros(len(seen), dtype=bool)
+            mask[(-column_tfs).argsort()[:self.max_features]] = True
+            new_index = np.where(mask, np.cumsum(mask) - 1, -1)
+        new_index = new_index[map_index]
+
+        self.vocabulary_ = {term: int(j) for term, j in zip(seen_terms, new_index.tolist()) if j >= 0}
+        n_features = len(self.vocabulary_)
+
+        # Smoothed idf, computed as TfidfTransformer does.
+        kept = new_index >= 0
+        column_df = np.zeros(n_features, dtype=np.float64)
+        column_df[new_index[kept]] = df[seen[kept]]
+        column_df += 1.0
+        idf = np.full_like(column_df, fill_value=len(seqs) + 1)
+        idf /= column_df
+        np.log(idf, out=idf)
+        idf += 1.0
+        self.idf_ = idf
+
+        self.terms_ = (indptr, term_ids, n_terms)
+        self.rank_ = rank
+        self.column_ = new_index
+        self.nnz_ = int(df[seen[kept]].sum())
+        return self
+
+    def allocate(self, name, dtype, shape):
+        if self.out_dir is None:
+            return np.empty(shape, dtype=dtype)
+        return np.lib.format.open_memmap(os.path.join(self.out_dir, '{}.npy'.format(name)), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def fit_transform(self, seqs):
+        """
+        Second pass: the TF-IDF rows of each chunk are written into arrays sized
+        from the first pass, memory-mapped under `out_dir` if it is set.
+        """
+        self.fit(seqs)
+        indptr, term_ids, n_terms = self.terms_
+        shape = (len(seqs), len(self.vocabulary_))
+
+        transformer = TfidfTransformer()
+        transformer.idf_ = self.idf_
+
+        # One index dtype for both arrays, or scipy would copy them to a common one.
+        index_dtype = np.int32 if max(self.nnz_, shape[1]) < np.iinfo(np.int32).max else np.int64
+        data = self.allocate('data', np.float64, (self.nnz_,))
+        indices = self.allocate('indices', index_dtype, (self.nnz_,))
+        row_ptr = self.allocate('indptr', index_dtype, (len(seqs) + 1,))
+        row_ptr[0] = 0
+        row, pos = 0, 0
+        for counts, _ in self.iter_counts(seqs, indptr, term_ids, n_terms):
+            X = sparse.csr_matrix((counts.data, self.rank_[counts.indices], counts.indptr), shape=counts.shape)
+            X.has_sorted_indices = False
+            X.sort_indices()
+            cols = self.column_[X.indices]
+            keep = cols >= 0
+            X = sparse.csr_matrix((X.data[keep], cols[keep], np.cumsum(np.r_[0, keep])[X.indptr]),
+                                  shape=(X.shape[0], shape[1]))
+            X = transformer.transform(X, copy=False)
+
+            n_rows = X.shape[0]
+            data[pos:pos+X.nnz] = X.data
+            indices[pos:pos+X.nnz] = X.indices
+            row_ptr[row+1:row+n_rows+1] = X.indptr[1:] + pos
+            row += n_rows
+            pos += X.nnz
+        assert pos == self.nnz_
+
+        return sparse.csr_matrix((data, indices, row_ptr), shape=shape, copy=False)
+
+
+class TokenHashingVectorizer(object):
+    def __init__(self, vocab, type_vocab=None, max_ngram=2, n_features=1 << 18, chunk_size=1 << 18):
+        super(TokenHashingVectorizer, self).__init__()
+        self.vocab = vocab
+        self.type_vocab = type_vocab
+        self.max_ngram = max_ngram
+        self.n_features = n_features
+        self.chunk_size = chunk_size
+
+    def hash_values(self, values, seed):
+        return np.array([murmurhash3_32(x, seed=seed, positive=True) for x in values], dtype=np.uint64)
+
+    def hash_ngrams(self, hashes, file_ids, n):
+        """
+        Returns (file id, hash) of every n-gram that lies within one file.
+        """
+        m = len(hashes) - n + 1
+        if m <= 0:
+            return file_ids[:0], hashes[:0]
+        h = np.full(m, n, dtype=np.uint64)
+        for k in range(n):
+            h = (h * HASH_PRIME) ^ hashes[k:k+m]
+        h ^= h >> np.uint64(29)
+        inside = file_ids[:m] == file_ids[n-1:]
+        return file_ids[:m][inside], h[inside]
+
+    def count_chunk(self, sequences, offsets):
+        """
+        Hashed n-gram counts of a chunk of files. `sequences` is a list of
+        (hashes, ids) pairs, one per kind of n-gram.
+        """
+        n_files = len(offsets) - 1
+        file_ids = np.repeat(np.arange(n_files), np.diff(offsets))
+        rows = []
+        cols = []
+        for table, ids in sequences:
+            hashes = table[ids]
+            for n in range(1, self.max_ngram + 1):
+                row, h = self.hash_ngrams(hashes, file_ids, n)
+                rows.append(row)
+                cols.append((h % np.uint64(self.n_features)).astype(np.int64))
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        data = np.ones(len(rows), dtype=np.float64)
+        return sparse.coo_matrix((data, (rows, cols)), shape=(n_files, self.n_features)).tocsr()
+
+    def fit_transform(self, seqs):
+        """
+        TF-IDF weighted hashed counts, built a chunk of files at a time. Tokens
+        and types are hashed with different seeds, so they never share a column
+        except by collision.
+        """
+        token_hashes = self.hash_values(self.vocab.values, seed=0)
+        type_hashes = None
+        if self.type_vocab is not None and seqs.type_ids is not None:
+            type_hashes = self.hash_values(self.type_vocab.values, seed=1)
+
+        offsets = seqs.offsets
+        chunks = []
+        for start, end in iter_chunks(offsets, self.chunk_size):
+            lo, hi = offsets[start], offsets[end]
+            sequences = [(token_hashes, seqs.token_ids[lo:hi])]
+            if type_hashes is not None:
+                sequences.append((type_hashes, seqs.type_ids[lo:hi]))
+            chunks.append(self.count_chunk(sequences, offsets[start:end+1] - lo))
+        if len(chunks) == 0:
+            X = sparse.csr_matrix((0, self.n_features), dtype=np.float64)
+        else:
+            X = sparse.vstack(chunks, format='csr')
+
+        transformer = TfidfTransformer()
+        transformer.fit(X)
+        return transformer.transform(X, copy=False)
+
+
+class FeatureStore(object):
+    """
+    A feature matrix converted once to float32 with int32 indices, the dtypes
+    sklearn's forests work in, and kept in both CSR and CSC layouts. Fold
+    subsets are row slices: of the CSC copy for fitting (the layout tree
+    building needs) and of the CSR one for prediction, so neither fit nor
+    predict has to convert them again.
+    """
+
+    def __init__(self, X, X_csc=None):
+        super(FeatureStore, self).__init__()
+        X = sparse.csr_matrix(X, dtype=np.float32)
+        if not X.has_sorted_indices:
+            # Sorted in place, and X may hold read-only memmaps from the cache.
+            X = X.copy()
+            X.sort_indices()
+        if X.nnz < np.iinfo(np.int32).max:
+            X.indices = X.indices.astype(np.int32, copy=False)
+            X.indptr = X.indptr.astype(np.int32, copy=False)
+        self.X = X
+        if X_csc is None:
+            X_csc = X.tocsc()
+        self.X_csc = X_csc
+
+    @property
+    def shape(self):
+        return self.X.shape
+
+    def train(self, index):
+        return self.X_csc[index]
+
+    def test(self, index):
+        return self.X[index]
+
+    def save(self, arrays):
+        for name, X in (('X', self.X), ('X_csc', self.X_csc)):
+            arrays[name + '_data'] = X.data
+            arrays[name + '_indices'] = X.indices
+            arrays[name + '_indptr'] = X.indptr
+        arrays['X_shape'] = np.array(self.shape, dtype=np.int64)
+
+    @classmethod
+    def load(cls, arrays):
+        shape = tuple(arrays['X_shape'].tolist())
+        X = sparse.csr_matrix((arrays['X_data'], arrays['X_indices'], arrays['X_indptr']), shape=shape, copy=False)
+        X_csc = sparse.csc_matrix((arrays['X_csc_data'], arrays['X_csc_indices'], arrays['X_csc_indptr']),
+                                  shape=shape, copy=False)
+        return cls(X, X_csc)
@@ -4,8 +4,9 @@ from collections import Counter
 
 import numpy as np
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-
+from codeauthorship.dataset.encoding import TokenSequences
+from codeauthorship.dataset.sampling import LabelGroups
+from codeauthorship.dataset.featurizing import TokenHashingVectorizer, TokenTfidfVectorizer
 from codeauthorship.utils.logging import *
 
 
@@ -22,99 +23,86 @@ class DatasetManager(object):
 
         logger = get_logger()
 
+        # Always 9, as before; --cutoff does not apply here.
         files_per_author = 9
 
-        # 1. Accumulate all data.
-        all_text_data = []
-        all_labels = []
-        all_languages = []
-
-        for dset in datasets:
-            all_text_data += dset['primary']
-            all_labels += dset['secondary']['labels']
-            all_languages += dset['secondary']['lang']
+        # 1. Accumulate the labels and languages. The sequences stay in their
+        # datasets and are only gathered once, in step 4.
+        all_labels = np.concatenate([dset['secondary']['labels'] for dset in datasets])
+        language_lst = [dset['metadata']['language'] for dset in datasets]
+        all_languages = np.repeat(np.arange(len(datasets)), [len(dset['primary']) for dset in datasets])
 
         # 2. Shuffle the data.
         N = len(all_labels)
         rindex = np.arange(N)
         random.shuffle(rindex)
-        all_text_data = [all_text_data[i] for i in rindex]
-        all_labels = [all_labels[i] for i in rindex]
-        all_languages = [all_languages[i] for i in rindex]
-
-        Y = np.array(all_labels)
+        all_labels = all_labels[rindex]
+        all_languages = all_languages[rindex]
 
         # 3. Record an index matching our criteria.
 
         ## First record 9 instances from each class (ignore classes with less than 9 instances).
-        index = np.arange(N)
-        index_to_keep = []
-        language_distribution_lst = []
-        label_lst = list(set(all_labels))
+        groups = LabelGroups(all_labels)
+        label_lst = list(set(all_labels.tolist()))
         random.shuffle(label_lst)
+        order = groups.find(label_lst)
 
-        found = 0
-        for label in label_lst:
-            mask = Y == label
-            if self.options.exact:
-                if mask.sum() != files_per_author:
-                    continue
-            else:
-                if mask.sum() < files_per_author:
-                    continue
-            if self.options.multilang:
-                subindex = index[mask].tolist()
-                sublanguages = [all_languages[idx] for idx in subindex]
-                if len(set(sublanguages)) == 1:
-                    continue
-            # TODO: Should we take all of the instances?
-            subindex = index[mask].tolist()[:files_per_author]
-            index_to_keep += subindex
-            found += 1
-
-            sublanguages = [all_languages[idx] for idx in subindex]
-            language_distribution_lst.append(tuple(set(sublanguages)))
+        languages = all_languages if self.options.multilang else None
+        eligible = groups.eligible(files_per_author, exact=self.options.exact, languages=languages)
+        chosen = order[eligible[order]]
+        found = len(chosen)
+        logger.info('found {} eligible classes'.format(found))
 
         ## Optionally, downsample eligible classes.
-        assert len(index_to_keep) == files_per_author * found
-        logger.info('found {} eligible classes'.format(found))
         if self.options.max_classes is not None:
-            index_to_keep = index_to_keep[:self.options.max_classes*files_per_author]
-            language_distribution_lst = language_distribution_lst[:self.options.max_classes]
-            logger.info('downsampled to {} classes'.format(len(index_to_keep) // files_per_author))
+            chosen = chosen[:self.options.max_classes]
+            logger.info('downsampled to {} classes'.format(len(chosen)))
 
-        language_distribution = Counter(language_distribution_lst)
+        # TODO: Should we take all of the instances?
+        index_to_keep = groups.take(chosen, files_per_author)
 
-        logger.info('language-distribution={}'.format(language_distribution))
+        language_distribution = Counter(
+            tuple(set(language_lst[i] for i in sublanguages))
+            for sublanguages in all_languages[index_to_keep].reshape(-1, files_per_author).tolist())
 
-        index_to_keep = np.array(index_to_keep)
+        logger.info('language-distribution={}'.format(language_distribution))
 
         # 4. Filter the data accordingly.
-        text_data = [all_text_data[i] for i in index_to_keep]
-        labels = [all_labels[i] for i in index_to_keep]
-        languages = [all_languages[i] for i in index_to_keep]
+        text_data = TokenSequences.take_from([dset['primary'] for dset in datasets], rindex[index_to_keep])
+        labels = all_labels[index_to_keep]
+        languages = [language_lst[i] for i in all_languages[index_to_keep].tolist()]
 
         return text_data, labels, languages
 
-    def build(self, raw_datasets):
+    def vectorize(self, text_data, labels, vocab, type_vocab):
         logger = get_logger()
 
         # Configuration.
         max_features = self.options.max_features
 
+        if self.options.featurizer == 'hashed':
+            logger.info('hashed n-gram data')
+            vectorizer = TokenHashingVectorizer(vocab, type_vocab, max_ngram=self.options.max_ngram,
+                                                n_features=self.options.n_hash_features,
+                                                chunk_size=self.options.tfidf_chunk_size)
+        else:
+            logger.info('tfidf data')
+            vectorizer = TokenTfidfVectorizer(vocab, max_features=max_features, exact=self.options.exact_tokens,
+                                              chunk_size=self.options.tfidf_chunk_size,
+                                              out_dir=self.options.tfidf_dir)
+        X = vectorizer.fit_transform(text_data)
+        Y = np.array(labels)
+
+        return X, Y
+
+    def build(self, raw_datasets):
+        logger = get_logger()
+
         # Balance data.
         logger.info('balancing data')
         raw_text_data, labels, languages = self.balance_data(raw_datasets)
 
-        logger.info('joining strings')
-        contents = []
-        for x in raw_text_data:
-            contents.append(' '.join(x))
-            del x
-
-        logger.info('tfidf data')
-        vectorizer = TfidfVectorizer(max_features=max_features)
-        X = vectorizer.fit_transform(contents)
-        Y = np.array(labels)
+        metadata = raw_datasets[0]['metadata']
+        X, Y = self.vectorize(raw_text_data, labels, metadata['vocab'], metadata['type_vocab'])
 
         return X, Y, languages
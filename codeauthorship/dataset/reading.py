@@ -1,12 +1,22 @@
+import copy
 import json
+import multiprocessing
+import queue
+import re
 
-from collections import deque, Counter
+from collections import Counter
 
 import keyword
 import builtins
 
+import numpy as np
+
 from tqdm import tqdm
 
+from codeauthorship.dataset.author_index import AuthorIndex, is_indexable, select_authors
+from codeauthorship.dataset.author_usage import AuthorUsage
+from codeauthorship.dataset.corpus import TokenCorpus, is_corpus, iter_records, read_jsonl_pipelined
+from codeauthorship.dataset.encoding import TOKEN_DTYPE, TYPE_DTYPE, SequenceBuilder, TokenSequences, Vocab
 from codeauthorship.utils.logging import *
 
 
@@ -17,6 +27,21 @@ def get_reserved_words():
     return set(reserved_words)
 
 
+def report_progress(records, progress, every=1000):
+    """
+    Pass records through, putting the number read on the `progress` queue
+    every `every` records.
+    """
+    n = 0
+    for ex in records:
+        yield ex
+        n += 1
+        if n == every:
+            progress.put(n)
+            n = 0
+    progress.put(n)
+
+
 def indexify(value2idx, lst):
     def func():
         for x in lst:
@@ -27,6 +52,152 @@ def indexify(value2idx, lst):
     return list(func())
 
 
+class TokenProjection(object):
+    """
+    Which tokens to keep (by type, and by value for reserved/notreserved) and
+    whether to lowercase them. The reader applies it while parsing, so rejected
+    tokens never become Python objects. Projected records carry parallel
+    `types` and `vals` lists in place of `tokens`, and `empty` if the file had
+    no tokens before projection.
+    """
+
+    TOKENS_KEY = '"tokens": ['
+    VAL_PATTERN = r'"val": "((?:[^"\\]|\\.)*)"'
+
+    def __init__(self, include_type=(), exclude_type=(), reserved=False, notreserved=False, lowercase=False):
+        super(TokenProjection, self).__init__()
+        self.include_type = set(include_type)
+        self.exclude_type = set(exclude_type)
+        self.reserved = reserved
+        self.notreserved = notreserved
+        self.lowercase = lowercase
+        self.reserved_words = get_reserved_words()
+
+        # Matches only the tokens of kept types, so the regex engine skips the rest.
+        if len(self.include_type) > 0:
+            kept = sorted(self.include_type - self.exclude_type)
+            type_pattern = '(?:{})'.format('|'.join([re.escape(x) for x in kept])) if len(kept) > 0 else '(?!)'
+        elif len(self.exclude_type) > 0:
+            rejected = '|'.join([re.escape(x) for x in sorted(self.exclude_type)])
+            type_pattern = '(?!(?:{})")[^"]*'.format(rejected)
+        else:
+            type_pattern = '[^"]*'
+        self.token_re = re.compile(r'\{"type": "(' + type_pattern + r')", ' + self.VAL_PATTERN + r'\}')
+
+    @classmethod
+    def from_options(cls, options):
+        include_type = [x for x in options.include_type.split(',') if len(x)>0]
+        exclude_type = [x for x in options.exclude_type.split(',') if len(x)>0]
+        return cls(include_type, exclude_type, reserved=options.reserved, notreserved=options.notreserved,
+                   lowercase=True) # NOTE: Case is ignored.
+
+    def keep_type(self, token_type):
+        if token_type in self.exclude_type:
+            return False
+        if len(self.include_type) > 0 and token_type not in self.include_type:
+            return False
+        return True
+
+    def keep_val(self, val):
+        if self.reserved and val not in self.reserved_words:
+            return False
+        if self.notreserved and val in self.reserved_words:
+            return False
+        return True
+
+    def normalize(self, val):
+        return val.lower() if self.lowercase else val
+
+    def filters_types(self):
+        return len(self.include_type) > 0 or len(self.exclude_type) > 0
+
+    def filters_vals(self):
+        return self.reserved or self.notreserved
+
+    def project(self, tokens):
+        """
+        Project a list of {'type': ..., 'val': ...} dicts.
+        """
+        if self.filters_types() or self.filters_vals():
+            tokens = [x for x in tokens if self.keep_type(x['type']) and self.keep_val(x['val'])]
+        types = [x['type'] for x in tokens]
+        if self.lowercase:
+            vals = [x['val'].lower() for x in tokens]
+        else:
+            vals = [x['val'] for x in tokens]
+        return types, vals
+
+    def type_table(self, type_vocab):
+        return np.array([self.keep_type(x) for x in type_vocab.values], dtype=bool)
+
+    def token_table(self, vocab):
+        if not self.filters_vals():
+            return np.ones(len(vocab), dtype=bool)
+        return np.array([self.keep_val(x) for x in vocab.values], dtype=bool)
+
+    def normalize_table(self, vocab):
+        # Interns the normalized values, so it is built after the other tables.
+        values = vocab.values[:]
+        return np.array(vocab.encode([self.normalize(x) for x in values]), dtype=np.int32)
+
+    def project_sequences(self, seq, vocab, type_vocab, keep_tokens=None):
+        """
+        Project encoded sequences. The filters are compiled into lookup tables
+        over type ids and token ids and applied to the whole corpus as one
+        mask. `keep_tokens` is an extra boolean table over token ids.
+        """
+        token_table = self.token_table(vocab)
+        if keep_tokens is not None:
+            token_table &= keep_tokens
+        keep = self.type_table(type_vocab)[seq.type_ids]
+        keep &= token_table[seq.token_ids]
+        seq = seq.filter(keep)
+        if self.lowercase:
+            seq = seq.map_tokens(self.normalize_table(vocab))
+        return seq
+
+    def project_record(self, ex):
+        rec = {k: v for k, v in ex.items() if k != 'tokens'}
+        rec['empty'] = len(ex['tokens']) == 0
+        rec['types'], rec['vals'] = self.project(ex['tokens'])
+        return rec
+
+    def parse_line(self, line):
+        """
+        Parse and project one JSONL line, as written by the converters. Lines
+        in any other layout, or when every type is kept, go through json.loads.
+        """
+        if not self.filters_types():
+            return self.project_record(json.loads(line))
+
+        start = line.find(self.TOKENS_KEY)
+        end = line.rfind(']')
+        body = line[start+len(self.TOKENS_KEY):end]
+        if start < 0 or not (len(body) == 0 or body.startswith('{"type": "')):
+            return self.project_record(json.loads(line))
+
+        try:
+            rec = json.loads(line[:start] + '"tokens": null' + line[end+1:])
+        except ValueError:
+            return self.project_record(json.loads(line))
+        del rec['tokens']
+
+        types = []
+        vals = []
+        for token_type, val in self.token_re.findall(body):
+            if '\\' in val:
+                val = json.loads('"' + val + '"')
+            if not self.keep_val(val):
+                continue
+            types.append(token_type)
+            vals.append(self.normalize(val))
+
+        rec['empty'] = len(body) == 0
+        rec['types'] = types
+        rec['vals'] = vals
+        return rec
+
+
 class DatasetReader(object):
     def __init__(self, options):
         super(DatasetReader, self).__init__()
@@ -36,38 +207,207 @@ class DatasetReader(object):
         self.path_c = options.path_c
         self.path_cpp = options.path_cpp
 
-        self.dataset_py = PyDataset(options)
-        self.dataset_c = CDataset(options)
-        self.dataset_cpp = CPPDataset(options)
+        # Shared by every language, so token ids are comparable across datasets.
+        self.vocab = Vocab()
+        self.type_vocab = Vocab()
+
+        self.dataset_py = PyDataset(options, self.vocab, self.type_vocab)
+        self.dataset_c = CDataset(options, self.vocab, self.type_vocab)
+        self.dataset_cpp = CPPDataset(options, self.vocab, self.type_vocab)
 
-    def readfile(self, path):
+        # Queue that a worker process reports its read count to, see read_concurrent.
+        self.progress = None
+
+    def get_projection(self):
+        if self.options.author_usage is not None:
+            # Usage is counted over every token, so Dataset.build filters after counting.
+            return TokenProjection()
+        return TokenProjection.from_options(self.options)
+
+    def readfile(self, path, index=None, authors=None):
+        """
+        Records are yielded as they are read, so Dataset.build can encode them
+        without holding every record in memory.
+        """
+        projection = self.get_projection()
         def func():
-            with open(path) as f:
-                for line in tqdm(f, desc='read', disable=not self.options.show_progress):
-                    ex = json.loads(line)
-                    if len(ex['tokens']) == 0:
-                        continue
-                    yield ex
-        return list(func())
+            if index is not None:
+                records = index.read(authors, projection)
+            elif self.options.parse_jobs > 1 and not is_corpus(path):
+                records = read_jsonl_pipelined(path, projection, workers=self.options.parse_jobs,
+                                               max_in_flight=self.options.max_in_flight)
+            else:
+                records = iter_records(path, projection)
+            if self.progress is not None:
+                records = report_progress(records, self.progress)
+            else:
+                records = tqdm(records, desc='read', disable=not self.options.show_progress)
+            for ex in records:
+                if ex['empty']:
+                    continue
+                yield ex
+        return func()
+
+    def read_corpus(self, path, dset):
+        """
+        Build a dataset straight from the id arrays of a binary corpus. Corpus
+        ids are mapped to the shared vocab with lookup tables, and the
+        projection is applied to the whole corpus at once.
+        """
+        corpus = TokenCorpus(path)
+        token_lookup = np.array(self.vocab.encode(corpus.vocab), dtype=np.int32)
+        type_lookup = np.array(self.type_vocab.encode(corpus.types), dtype=np.uint8)
+        seq = TokenSequences(token_lookup[corpus.token_ids], type_lookup[corpus.type_ids], np.array(corpus.offsets))
+
+        # Empty files are skipped, as in readfile.
+        index = np.flatnonzero(seq.lengths() > 0)
+        seq = seq.take(index)
+        usernames = [corpus.authors[x] for x in corpus.author_ids[index].tolist()]
+        example_ids = [str(x) for x in corpus.example_ids[index].tolist()]
+
+        return dset.build_encoded(seq, usernames, example_ids, TokenProjection.from_options(self.options))
+
+    def read_indexes(self):
+        """
+        Returns the author index of each corpus, or None if the full corpora
+        have to be read.
+        """
+        logger = get_logger()
+
+        if self.options.author_usage is not None:
+            # Usage counts are over every author, so every record is needed.
+            logger.info('author index is not used with --author_usage')
+            return None
+
+        indexes = {}
+        for path, dset in [(self.path_py, self.dataset_py), (self.path_c, self.dataset_c), (self.path_cpp, self.dataset_cpp)]:
+            if path is None:
+                continue
+            if not is_indexable(path):
+                logger.info('author index is not used, {} is not a plain JSONL file'.format(path))
+                return None
+            indexes[path] = AuthorIndex.load_or_build(path, dset.language, show_progress=self.options.show_progress)
+        return indexes
+
+    def get_sources(self):
+        """
+        (path, dataset) for each language that has a path, in a fixed order.
+        """
+        sources = [(self.path_py, self.dataset_py), (self.path_c, self.dataset_c), (self.path_cpp, self.dataset_cpp)]
+        return [(path, dset) for path, dset in sources if path is not None]
+
+    def get_dataset(self, language):
+        for dset in [self.dataset_py, self.dataset_c, self.dataset_cpp]:
+            if dset.language == language:
+                return dset
+        raise ValueError(language)
+
+    def build(self, path, dset, index=None, authors=None):
+        if index is not None:
+            return dset.build(self.readfile(path, index=index, authors=authors))
+        if is_corpus(path):
+            return self.read_corpus(path, dset)
+        return dset.build(self.readfile(path))
+
+    def merge_vocab(self, dataset):
+        """
+        Map a dataset that was read with its own vocabs (in a worker process)
+        onto the shared ones. Values are interned in the worker's order, so the
+        ids are the same as if the languages had been read one after another.
+        """
+        metadata = dataset['metadata']
+        token_lookup = np.array(self.vocab.encode(metadata['vocab'].values), dtype=TOKEN_DTYPE)
+        type_lookup = np.array(self.type_vocab.encode(metadata['type_vocab'].values), dtype=TYPE_DTYPE)
+        seq = dataset['primary']
+        type_ids = type_lookup[seq.type_ids] if seq.type_ids is not None else None
+        dataset['primary'] = TokenSequences(token_lookup[seq.token_ids], type_ids, seq.offsets)
+        metadata['vocab'] = self.vocab
+        metadata['type_vocab'] = self.type_vocab
+        return dataset
+
+    def read_concurrent(self, sources, n_jobs, indexes=None, authors=None):
+        """
+        Read each language in its own process. Workers report how many records
+        they have read through a queue, so there is one progress bar for all.
+        """
+        logger = get_logger()
+        logger.info('reading {} languages with {} processes'.format(len(sources), n_jobs))
+
+        manager = None
+        progress = None
+        if self.options.show_progress:
+            manager = multiprocessing.Manager()
+            progress = manager.Queue()
+
+        with multiprocessing.Pool(n_jobs) as pool:
+            results = []
+            for path, dset in sources:
+                index = indexes[path] if indexes is not None else None
+                args = (self.options, dset.language, path, index, authors, progress)
+                results.append(pool.apply_async(read_language, args))
+
+            if progress is not None:
+                with tqdm(desc='read') as pbar:
+                    while not all([x.ready() for x in results]):
+                        try:
+                            pbar.update(progress.get(timeout=0.1))
+                        except queue.Empty:
+                            pass
+                    while not progress.empty():
+                        pbar.update(progress.get())
+
+            datasets = [self.merge_vocab(x.get()) for x in results]
+
+        if manager is not None:
+            manager.shutdown()
+
+        return datasets
 
     def read(self):
-        datasets = []
-
-        if self.path_py is not None:
-            records = self.readfile(self.path_py)
-            datasets.append(self.dataset_py.build(records))
-        if self.path_c is not None:
-            records = self.readfile(self.path_c)
-            datasets.append(self.dataset_c.build(records))
-        if self.path_cpp is not None:
-            records = self.readfile(self.path_cpp)
-            datasets.append(self.dataset_cpp.build(records))
+        logger = get_logger()
+
+        indexes = None
+        authors = None
+        if self.options.author_index:
+            indexes = self.read_indexes()
+        if indexes is not None:
+            authors, n_authors = select_authors(indexes.values(), self.options)
+            logger.info('author index selected {} of {} authors'.format(len(authors), n_authors))
+
+        sources = self.get_sources()
+        n_jobs = self.options.read_jobs
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        n_jobs = min(n_jobs, len(sources))
+
+        if n_jobs > 1:
+            datasets = self.read_concurrent(sources, n_jobs, indexes, authors)
+        else:
+            datasets = []
+            for path, dset in sources:
+                index = indexes[path] if indexes is not None else None
+                datasets.append(self.build(path, dset, index, authors))
 
         datasets = ConsolidateDatasets().build(datasets)
 
         return datasets
 
 
+def read_language(options, language, path, index=None, authors=None, progress=None):
+    """
+    Read one language with a reader of its own (so with its own vocabs), for
+    DatasetReader.read_concurrent. Runs in a worker process.
+    """
+    # Progress goes through the queue; the worker shows no bars of its own.
+    # Pool workers are daemonic and cannot start a parsing pool of their own.
+    options = copy.copy(options)
+    options.show_progress = False
+    options.parse_jobs = 1
+    reader = DatasetReader(options)
+    reader.progress = progress
+    return reader.build(path, reader.get_dataset(language), index, authors)
+
+
 class ConsolidateDatasets(object):
     def consolidate_mappings(self, mapping_lst):
         master_mapping = {}
@@ -75,23 +415,16 @@ class ConsolidateDatasets(object):
         for x2y in mapping_lst:
             old2master = {}
             for x, y in x2y.items():
-                if x not in inverse_mapping_lst:
+                if x not in master_mapping:
                     master_mapping[x] = len(master_mapping)
                 old2master[y] = master_mapping[x]
             inverse_mapping_lst.append(old2master)
         return master_mapping, inverse_mapping_lst
 
     def reindex(self, data, inverse_mapping):
-        def fn(s):
-            if isinstance(s, (list, tuple)):
-                return [inverse_mapping[idx] for idx in s]
-            else:
-                return inverse_mapping[s]
-        def queue(lst):
-            q = deque(lst)
-            while len(q) > 0:
-                yield q.popleft()
-        return [fn(s) for s in queue(data)]
+        lookup = np.zeros(len(inverse_mapping), dtype=data.dtype)
+        lookup[list(inverse_mapping.keys())] = list(inverse_mapping.values())
+        return lookup[data]
 
     def build(self, datasets):
         """
@@ -112,73 +445,58 @@ class ConsolidateDatasets(object):
 class Dataset(object):
     language = None
 
-    def __init__(self, options):
+    def __init__(self, options, vocab, type_vocab):
         super(Dataset, self).__init__()
         self.options = options
+        self.vocab = vocab
+        self.type_vocab = type_vocab
 
-    def get_author_usage(self, records):
-        author_usage = {}
-        for rec in records:
-            tokens = rec['tokens']
-            label = rec['username']
+    def build(self, records):
+        """
+        Records are projected by DatasetReader (see TokenProjection), except
+        with --author_usage where every token is read, and the projection is
+        applied to the encoded sequences after usage is counted.
+        """
+        seq = SequenceBuilder(self.vocab, self.type_vocab)
+        usernames = []
+        example_ids = []
 
-            for x in tokens:
-                author_usage.setdefault(x['val'], set()).add(label)
-        return author_usage
+        for ex in tqdm(records, desc='build', disable=not self.options.show_progress):
+            seq.add(ex['vals'], ex['types'])
+            usernames.append(ex['username'])
+            example_ids.append(ex['example_id'])
 
-    def build(self, records):
-        logger = get_logger()
+        projection = None
+        if self.options.author_usage is not None:
+            projection = TokenProjection.from_options(self.options)
 
-        include_type = set([x for x in self.options.include_type.split(',') if len(x)>0])
-        exclude_type = set([x for x in self.options.exclude_type.split(',') if len(x)>0])
-        reserved_words = get_reserved_words()
+        return self.build_encoded(seq.build(), usernames, example_ids, projection)
 
-        dataset = {}
+    def build_encoded(self, seq, usernames, example_ids, projection=None):
+        """
+        The primary data is a TokenSequences of token ids into
+        metadata['vocab'] and type ids into metadata['type_vocab'].
+        """
+        logger = get_logger()
 
-        # Primary data.
-        seq = []
+        dataset = {}
 
         # Secondary data. len(seq) == len(extra[key])
         extra = {}
-        labels = []
-        example_ids = []
-        if self.options.extra_type:
-            seq_types = []
 
         # Metadata. Information about the dataset.
         metadata = {}
 
-        if self.options.author_usage is not None:
-            author_usage = self.get_author_usage(records)
-        
-        for i, ex in tqdm(enumerate(records), desc='build', disable=not self.options.show_progress):
-            tokens = ex['tokens']
-            if len(exclude_type) > 0:
-                token_types = [x['type'] for x in tokens]
-                tokens = [tokens[i] for i in range(len(tokens))
-                          if token_types[i] not in exclude_type]
-
-            if len(include_type) > 0:
-                token_types = [x['type'] for x in tokens]
-                tokens = [tokens[i] for i in range(len(tokens))
-                          if token_types[i] in include_type]
-
-            if self.options.reserved:
-                tokens = [x for x in tokens if x['val'] in reserved_words]
-            if self.options.notreserved:
-                tokens = [x for x in tokens if x['val'] not in reserved_words]
-            if self.options.author_usage is not None:
-                tokens = [x for x in tokens if len(author_usage[x['val']]) >= self.options.author_usage]
-
-            seq.append([x['val'].lower() for x in tokens]) # NOTE: Case is ignored.
-            labels.append(ex['username'])
-            example_ids.append(ex['example_id'])
-
-            if self.options.extra_type:
-                seq_types.append([x['type'] for x in tokens])
-
         # Indexify if needed.
-        labels, label2idx = self.build_label_vocab(labels)
+        labels, label2idx = self.build_label_vocab(usernames)
+        labels = np.array(labels, dtype=np.int64)
+
+        if projection is not None:
+            keep_tokens = None
+            if self.options.author_usage is not None:
+                author_usage = AuthorUsage.from_sequences(seq, labels, len(self.vocab))
+                keep_tokens = author_usage.keep(self.options.author_usage)
+            seq = projection.project_sequences(seq, self.vocab, self.type_vocab, keep_tokens)
 
         # Record everything.
         extra['example_ids'] = example_ids
@@ -186,15 +504,14 @@ class Dataset(object):
         extra['lang'] = [self.language] * len(example_ids)
 
         if self.options.extra_type:
-            extra['seq_types'] = seq_types
-
-            types_set = Counter()
-            for xs in seq_types:
-                types_set.update(xs)
+            type_counts = np.bincount(seq.type_ids, minlength=len(self.type_vocab))
+            types_set = Counter({self.type_vocab[i]: int(x) for i, x in enumerate(type_counts) if x > 0})
             logger.info('TYPES: {}'.format(types_set))
 
         metadata['label2idx'] = label2idx
         metadata['language'] = self.language
+        metadata['vocab'] = self.vocab
+        metadata['type_vocab'] = self.type_vocab
 
         dataset['primary'] = seq
         dataset['secondary'] = extra
@@ -0,0 +1,69 @@
+"""
+Author-balanced sampling.
+
+`LabelGroups` sorts the file indices by label once (a stable argsort), so the
+files of every label are a contiguous run in their original order. Eligibility
+(--cutoff, --exact, --multilang) is then computed for all labels at once from
+the run lengths, and taking the first `cutoff` files of each chosen label is a
+single gather, instead of a `Y == label` scan over every file per label.
+"""
+
+import numpy as np
+
+
+class LabelGroups(object):
+    def __init__(self, labels):
+        super(LabelGroups, self).__init__()
+        self.labels, inverse = np.unique(np.asarray(labels), return_inverse=True)
+        self.order = np.argsort(inverse.ravel(), kind='stable')
+        self.counts = np.bincount(inverse.ravel(), minlength=len(self.labels))
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def __len__(self):
+        return len(self.labels)
+
+    def find(self, labels):
+        """
+        Group positions of the given label values.
+        """
+        return np.searchsorted(self.labels, np.asarray(labels))
+
+    def eligible(self, cutoff, exact=False, languages=None):
+        """
+        Boolean mask over the groups: at least (or with `exact`, exactly)
+        `cutoff` files, and if `languages` is given, files in more than one
+        language.
+        """
+        if exact:
+            mask = self.counts == cutoff
+        else:
+            mask = self.counts >= cutoff
+        if languages is not None and len(self.labels) > 0:
+            _, lang_ids = np.unique(np.asarray(languages), return_inverse=True)
+            lang_ids = lang_ids.ravel()[self.order]
+            mask &= np.minimum.reduceat(lang_ids, self.starts) != np.maximum.reduceat(lang_ids, self.starts)
+        return mask
+
+    def take(self, groups, n):
+        """
+        Indices of the first `n` files of each group, group by group.
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        return self.order[(self.starts[groups][:, None] + np.arange(n)).ravel()]
+
+
+def balanced_sample(labels, cutoff, exact=False, languages=None, label_order=None, max_classes=None):
+    """
+    Indices of the first `cutoff` files of every eligible label, taken label by
+    label in `label_order` (default: ascending), for at most `max_classes`
+    labels.
+    """
+    groups = LabelGroups(labels)
+    if label_order is None:
+        order = np.arange(len(groups))
+    else:
+        order = groups.find(label_order)
+    chosen = order[groups.eligible(cutoff, exact=exact, languages=languages)[order]]
+    if max_classes is not None:
+        chosen = chosen[:max_classes]
+    return groups.take(chosen, cutoff)
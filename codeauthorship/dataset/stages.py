@@ -0,0 +1,145 @@
+"""
+The read -> balance -> vectorize pipeline of train_multilang, with each
+stage's output stored in a StageCache (see utils/cache.py).
+
+A stage's key covers the input file fingerprints, the options that stage
+reads, and the key of the stage before it, so changing only the model options
+reuses every stage, and changing e.g. --max_features reuses the balanced data.
+The deepest stage that is cached is loaded and only the stages after it run.
+
+Stages that draw from `random` also key on the seed and store the random state
+they finish with, which is restored on a hit, so a cached run makes the same
+choices as an uncached one.
+"""
+
+from codeauthorship.dataset.encoding import TokenSequences, Vocab
+from codeauthorship.dataset.manager import DatasetManager
+from codeauthorship.dataset.reading import DatasetReader
+from codeauthorship.utils.cache import fingerprint, get_random_state, load_csr, make_key, save_csr, set_random_state
+from codeauthorship.utils.logging import *
+
+
+READ_OPTIONS = ('include_type', 'exclude_type', 'reserved', 'notreserved', 'author_usage', 'author_index')
+BALANCE_OPTIONS = ('cutoff', 'exact', 'multilang', 'max_classes')
+VECTORIZE_OPTIONS = ('featurizer', 'max_features', 'exact_tokens', 'max_ngram', 'n_hash_features')
+
+
+def get_keys(options):
+    paths = [options.path_py, options.path_c, options.path_cpp]
+    read_options = {k: getattr(options, k) for k in READ_OPTIONS}
+    if options.author_index:
+        # Authors are selected (at random) while reading.
+        read_options.update({k: getattr(options, k) for k in BALANCE_OPTIONS})
+        read_options['seed'] = options.seed
+    read_key = make_key('read', [fingerprint(x) if x is not None else None for x in paths], read_options)
+    balance_key = make_key('balance', read_key, {k: getattr(options, k) for k in BALANCE_OPTIONS}, options.seed)
+    vectorize_key = make_key('vectorize', balance_key, {k: getattr(options, k) for k in VECTORIZE_OPTIONS})
+    return read_key, balance_key, vectorize_key
+
+
+def save_sequences(arrays, name, seq):
+    arrays[name + '_token_ids'] = seq.token_ids
+    if seq.type_ids is not None:
+        arrays[name + '_type_ids'] = seq.type_ids
+    arrays[name + '_offsets'] = seq.offsets
+
+
+def load_sequences(arrays, name):
+    return TokenSequences(arrays[name + '_token_ids'], arrays.get(name + '_type_ids'), arrays[name + '_offsets'])
+
+
+def save_datasets(cache, key, datasets, random_state=None):
+    arrays = {}
+    meta = {'datasets': [], 'random_state': random_state}
+    for i, dset in enumerate(datasets):
+        save_sequences(arrays, 'primary{}'.format(i), dset['primary'])
+        arrays['labels{}'.format(i)] = dset['secondary']['labels']
+        meta['datasets'].append({
+            'example_ids': dset['secondary']['example_ids'],
+            'language': dset['metadata']['language'],
+            })
+    metadata = datasets[0]['metadata']
+    meta['label2idx'] = metadata['label2idx']
+    meta['vocab'] = metadata['vocab'].values
+    meta['type_vocab'] = metadata['type_vocab'].values
+    cache.put('read', key, arrays, meta)
+
+
+def load_datasets(arrays, meta):
+    vocab = Vocab(meta['vocab'])
+    type_vocab = Vocab(meta['type_vocab'])
+    datasets = []
+    for i, x in enumerate(meta['datasets']):
+        dataset = {}
+        dataset['primary'] = load_sequences(arrays, 'primary{}'.format(i))
+        dataset['secondary'] = {
+            'example_ids': x['example_ids'],
+            'labels': arrays['labels{}'.format(i)],
+            'lang': [x['language']] * len(x['example_ids']),
+            }
+        dataset['metadata'] = {
+            'label2idx': meta['label2idx'],
+            'language': x['language'],
+            'vocab': vocab,
+            'type_vocab': type_vocab,
+            }
+        datasets.append(dataset)
+    return datasets
+
+
+def build_cached(options, cache):
+    """
+    Same result as DatasetManager(options).build(DatasetReader(options).read()).
+    """
+    logger = get_logger()
+
+    read_key, balance_key, vectorize_key = get_keys(options)
+    manager = DatasetManager(options)
+
+    hit = cache.get('vectorize', vectorize_key)
+    if hit is not None:
+        logger.info('loaded vectorized data from cache')
+        arrays, meta = hit
+        set_random_state(meta['random_state'])
+        return load_csr(arrays, 'X'), arrays['Y'], meta['languages']
+
+    hit = cache.get('balance', balance_key)
+    if hit is not None:
+        logger.info('loaded balanced data from cache')
+        arrays, meta = hit
+        set_random_state(meta['random_state'])
+        text_data = load_sequences(arrays, 'text_data')
+        labels = arrays['labels']
+        languages = meta['languages']
+        vocab = Vocab(meta['vocab'])
+        type_vocab = Vocab(meta['type_vocab'])
+    else:
+        hit = cache.get('read', read_key)
+        if hit is not None:
+            logger.info('loaded datasets from cache')
+            arrays, meta = hit
+            if meta['random_state'] is not None:
+                set_random_state(meta['random_state'])
+            datasets = load_datasets(arrays, meta)
+        else:
+            datasets = DatasetReader(options).read()
+            save_datasets(cache, read_key, datasets, get_random_state() if options.author_index else None)
+
+        logger.info('balancing data')
+        text_data, labels, languages = manager.balance_data(datasets)
+        vocab = datasets[0]['metadata']['vocab']
+        type_vocab = datasets[0]['metadata']['type_vocab']
+
+        arrays = {'labels': labels}
+        save_sequences(arrays, 'text_data', text_data)
+        meta = {'languages': languages, 'vocab': vocab.values, 'type_vocab': type_vocab.values,
+                'random_state': get_random_state()}
+        cache.put('balance', balance_key, arrays, meta)
+
+    X, Y = manager.vectorize(text_data, labels, vocab, type_vocab)
+
+    arrays = {'Y': Y}
+    save_csr(arrays, 'X', X)
+    cache.put('vectorize', vectorize_key, arrays, {'languages': languages, 'random_state': get_random_state()})
+
+    return X, Y, languages
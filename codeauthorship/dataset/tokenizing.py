@@ -0,0 +1,117 @@
+"""
+Tokenizers used to build the token corpora from GCJ source files.
+
+Each tokenizer takes the source as an in-memory string and returns a list of
+{'type': ..., 'val': ...} dicts, raising an exception if the source can not be
+tokenized. clang is only imported when a C/C++ tokenizer is used.
+
+With `lex_only`, the C/C++ tokenizers skip the work that libclang does beyond
+lexing: includes are not searched for, function bodies are not parsed and
+diagnostics are disabled. Tokens come from the raw lexer over the main file in
+both modes, so the token stream is unchanged. See benchmark_tokenizer.py.
+"""
+
+import io
+import tokenize
+
+
+# One clang Index per process. Creating an Index allocates libclang state, so
+# it is reused for every file rather than created per row.
+_clang_index = None
+
+
+def get_clang_index():
+    global _clang_index
+    if _clang_index is None:
+        import clang.cindex
+        _clang_index = clang.cindex.Index.create()
+    return _clang_index
+
+
+class Tokenizer(object):
+    language = None
+    extension = None
+
+    def __init__(self, lex_only=False):
+        super(Tokenizer, self).__init__()
+        self.lex_only = lex_only
+
+    def accepts(self, filename):
+        return filename.endswith(self.extension)
+
+    def tokenize(self, source):
+        raise NotImplementedError
+
+
+class PyTokenizer(Tokenizer):
+    language = 'python'
+    extension = '.py'
+
+    def tokenize(self, source):
+        readline = io.BytesIO(source.encode('utf-8')).readline
+
+        tokens = []
+        for x in tokenize.tokenize(readline):
+            token = {}
+            token['type'] = tokenize.tok_name[x.type]
+            token['val'] = x.string
+            tokens.append(token)
+        return tokens
+
+
+class ClangTokenizer(Tokenizer):
+    # NOTE: C is also parsed as C++11, which is how the C corpora were built.
+    filename = 'tmp.cpp'
+    args = ['-std=c++11']
+    lex_only_args = ['-std=c++11', '-nostdinc', '-nostdinc++', '-Wno-everything']
+
+    def tokenize(self, source):
+        import clang.cindex
+
+        args = self.args
+        options = 0
+        if self.lex_only:
+            args = self.lex_only_args
+            options = (clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES |
+                       clang.cindex.TranslationUnit.PARSE_INCOMPLETE)
+
+        idx = get_clang_index()
+        tu = idx.parse(self.filename, args=args,
+                       unsaved_files=[(self.filename, source)], options=options)
+
+        tokens = []
+        for t in tu.get_tokens(extent=tu.cursor.extent):
+            token = {}
+            token['type'] = str(t.kind)
+            token['val'] = t.spelling
+            tokens.append(token)
+        return tokens
+
+
+class CTokenizer(ClangTokenizer):
+    language = 'c'
+    extension = '.c'
+
+
+class CPPTokenizer(ClangTokenizer):
+    language = 'cpp'
+    extension = '.cpp'
+
+
+TOKENIZERS = {
+    'python': PyTokenizer,
+    'c': CTokenizer,
+    'cpp': CPPTokenizer,
+}
+
+_tokenizers = {}
+
+
+def get_tokenizer(language, lex_only=False):
+    """
+    Returns the tokenizer for a language, shared within a process.
+    """
+    key = (language, lex_only)
+    if key not in _tokenizers:
+        _tokenizers[key] = TOKENIZERS[language](lex_only=lex_only)
+    return _tokenizers[key]
@@ -0,0 +1,76 @@
+"""
+Benchmark the corpus read path for plain and compressed copies of a JSONL corpus.
+
+For each format, reports the file size, the time to read the raw lines, and
+the time to read and parse every record (what DatasetReader.readfile does).
+Pass --drop_caches (as root) to measure cold reads rather than page cache hits.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from codeauthorship.dataset.corpus import read_jsonl
+from codeauthorship.utils.fileio import open_file
+
+
+def drop_caches():
+    subprocess.call(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def time_lines(path):
+    start = time.time()
+    n = 0
+    with open_file(path) as f:
+        for line in f:
+            n += 1
+    return n, time.time() - start
+
+
+def time_records(path):
+    start = time.time()
+    n = 0
+    for ex in read_jsonl(path):
+        n += 1
+    return n, time.time() - start
+
+
+def run(options):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = [options.path_in]
+        for ext in ('.gz', '.bz2', '.xz'):
+            path = os.path.join(tmpdir, 'corpus.jsonl' + ext)
+            print('writing = {}'.format(path))
+            with open_file(options.path_in, 'rb') as fin, open_file(path, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+            paths.append(path)
+
+        for path in paths:
+            size = os.path.getsize(path)
+            if options.drop_caches:
+                drop_caches()
+            n, lines_elapsed = time_lines(path)
+            if options.drop_caches:
+                drop_caches()
+            n, records_elapsed = time_records(path)
+            print('file={} size-mb={:.1f} records={} lines-sec={:.3f} parse-sec={:.3f}'.format(
+                os.path.basename(path), size / 2**20, n, lines_elapsed, records_elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_in', default='~/Downloads/gcj-py-small.jsonl', type=str)
+    parser.add_argument('--drop_caches', action='store_true')
+    options = parser.parse_args()
+
+    options.path_in = os.path.expanduser(options.path_in)
+
+    run(options)
@@ -0,0 +1,66 @@
+"""
+Compare the full parse and lex-only C/C++ tokenizers on a sample of GCJ files.
+
+Reports tokens/sec for each mode and the number of files whose (type, val)
+token stream differs between the two.
+"""
+
+import argparse
+import time
+
+import codeauthorship.codeauth_lib as codeauth_lib
+
+from codeauthorship.dataset.tokenizing import get_tokenizer
+
+
+def get_sample(path_in, language, max_files):
+    tokenizer = get_tokenizer(language)
+    sources = []
+    for row in codeauth_lib.files_getter(path_in, null=''):
+        if not tokenizer.accepts(row['file']):
+            continue
+        sources.append(row['flines'])
+        if len(sources) == max_files:
+            break
+    return sources
+
+
+def run_tokenizer(tokenizer, sources):
+    outputs = []
+    start = time.time()
+    for s in sources:
+        try:
+            outputs.append(tokenizer.tokenize(s))
+        except:
+            outputs.append(None)
+    elapsed = time.time() - start
+    return outputs, elapsed
+
+
+def run(options):
+    sources = get_sample(options.path_in, options.language, options.max_files)
+    print('files', len(sources))
+
+    results = {}
+    for lex_only in (False, True):
+        tokenizer = get_tokenizer(options.language, lex_only=lex_only)
+        # Warm up the clang Index so it is not counted.
+        run_tokenizer(tokenizer, sources[:1])
+        outputs, elapsed = run_tokenizer(tokenizer, sources)
+        n_tokens = sum([len(x) for x in outputs if x is not None])
+        print('lex_only={} tokens={} seconds={:.3f} tokens/sec={:.0f}'.format(
+            lex_only, n_tokens, elapsed, n_tokens / elapsed))
+        results[lex_only] = outputs
+
+    mismatch = sum([1 for x, y in zip(results[False], results[True]) if x != y])
+    print('mismatch {}/{}'.format(mismatch, len(sources)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_in', default='~/Downloads/gcj2008.csv', type=str)
+    parser.add_argument('--language', default='cpp', choices=('c', 'cpp'))
+    parser.add_argument('--max_files', default=1000, type=int)
+    options = parser.parse_args()
+
+    run(options)
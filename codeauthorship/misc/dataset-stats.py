@@ -1,26 +1,20 @@
 import argparse
 import os
-import json
 
 from collections import OrderedDict, Counter
 
+from codeauthorship.dataset.corpus import iter_columns
+
 
 def get_dataset(path):
     def read_data():
-        with open(path) as f:
-            for line in f:
-                data = json.loads(line)
-                label = data['username']
-                tokens = data['tokens']
-
-                # Only look at specific token types.
-                tokens = [x for x in tokens if x['type'] == 'NAME']
-
-                ex = {}
-                ex['label'] = label
-                ex['tokens'] = [x['val'] for x in tokens]
+        # Only look at specific token types.
+        for data in iter_columns(path, keep_types={'NAME'}):
+            ex = {}
+            ex['label'] = data['username']
+            ex['tokens'] = data['vals']
 
-                yield ex
+            yield ex
     records = list(read_data())
 
     labels = [x['label'] for x in records]
@@ -0,0 +1,39 @@
+"""
+Convert a JSONL token corpus (output of make_dataset_{py,c,cpp}.py) to the
+binary corpus format in codeauthorship/dataset/corpus.py.
+"""
+
+import argparse
+import os
+
+from tqdm import tqdm
+
+from codeauthorship.dataset.corpus import CorpusWriter, read_jsonl
+
+
+def convert_file(path_in, path_out):
+    print('reading = {}'.format(path_in))
+
+    with CorpusWriter(path_out) as writer:
+        for ex in tqdm(read_jsonl(path_in), desc='convert'):
+            writer.add(ex)
+
+    print('files', writer.n_files)
+    print('tokens', writer.n_tokens)
+    print('vocab', len(writer.token2idx))
+    print('writing = {}'.format(path_out))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_in', default='~/Downloads/gcj.jsonl', type=str)
+    parser.add_argument('--path_out', default=None, type=str)
+    options = parser.parse_args()
+
+    options.path_in = os.path.expanduser(options.path_in)
+
+    if options.path_out is None:
+        options.path_out = os.path.splitext(options.path_in)[0] + '.corpus'
+    options.path_out = os.path.expanduser(options.path_out)
+
+    convert_file(options.path_in, options.path_out)
@@ -0,0 +1,55 @@
+"""
+Build the Python, C and C++ corpora in a single pass over the GCJ CSVs.
+
+header:
+,year,round,username,task,solution,file,full_path,flines
+"""
+
+import argparse
+import os
+
+from codeauthorship.dataset.converting import convert_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_in', default='~/Downloads/gcj2008.csv,~/Downloads/gcj2017.csv', type=str)
+    parser.add_argument('--path_out_py', default='~/Downloads/gcj-py.jsonl', type=str)
+    parser.add_argument('--path_out_c', default='~/Downloads/gcj-c.jsonl', type=str)
+    parser.add_argument('--path_out_cpp', default='~/Downloads/gcj-cpp.jsonl', type=str)
+    parser.add_argument('--languages', default='py,c,cpp', type=str)
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--lex_only', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--preset', default='none', choices=('small', 'medium', 'table3', 'all', '2014'))
+    options = parser.parse_args()
+
+    preset_path_in = {
+        'small': '~/Downloads/gcj2008.csv',
+        '2014': '~/Downloads/gcj2014.csv',
+        'medium': '~/Downloads/gcj2017.csv',
+        'table3': '~/Downloads/gcj2015.csv,~/Downloads/gcj2016.csv',
+        'all': ','.join(['~/Downloads/gcj20{:02}.csv'.format(i) for i in range(8, 18)]),
+    }
+
+    if options.preset != 'none':
+        options.path_in = preset_path_in[options.preset]
+        options.path_out_py = '~/Downloads/gcj-py-{}.jsonl'.format(options.preset)
+        options.path_out_c = '~/Downloads/gcj-c-{}.jsonl'.format(options.preset)
+        options.path_out_cpp = '~/Downloads/gcj-cpp-{}.jsonl'.format(options.preset)
+
+    languages = dict(py='python', c='c', cpp='cpp')
+    paths_out = {}
+    for lang in options.languages.split(','):
+        path_out = getattr(options, 'path_out_{}'.format(lang))
+        paths_out[languages[lang]] = os.path.expanduser(path_out)
+
+    skipped, outputs = convert_files(options.path_in, paths_out, workers=options.workers,
+                                     lex_only=options.lex_only, incremental=options.incremental)
+
+    print('skipped', skipped)
+    for language, output in outputs.items():
+        print(language, 'failed', output.failed)
+        print(language, 'success', output.success)
+        if options.incremental:
+            print(language, 'resumed', output.resumed)
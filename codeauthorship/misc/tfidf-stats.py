@@ -13,10 +13,9 @@ from collections import Counter
 import numpy as np
 
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.model_selection import StratifiedKFold
 
-from codeauthorship.scripts.train_baseline import get_dataset, get_reserved_words
+from codeauthorship.scripts.train_baseline import get_dataset, get_reserved_words, get_tfidf
 from codeauthorship.scripts.train_baseline import get_argument_parser, parse_args
 
 
@@ -33,10 +32,7 @@ def run_top_ranking(options):
     idx2label = {v: k for k, v in label2idx.items()}
     labels = dataset['secondary']['labels']
 
-    contents = [' '.join(x) for x in dataset['primary']]
-
-    vectorizer = TfidfVectorizer()
-    X = vectorizer.fit_transform(contents)
+    vectorizer, X = get_tfidf(dataset, options)
     Y = np.array(labels)
 
     reserved_words = get_reserved_words()
@@ -89,10 +85,8 @@ def run_top_udf(options):
     idx2label = {v: k for k, v in label2idx.items()}
     labels = dataset['secondary']['labels']
 
-    contents = [' '.join(x) for x in dataset['primary']]
-
-    vectorizer = TfidfVectorizer()
-    X = vectorizer.fit_transform(contents).toarray()
+    vectorizer, X = get_tfidf(dataset, options)
+    X = X.toarray()
     Y = np.array(labels)
 
     Xargsort = np.argsort(X, axis=0)
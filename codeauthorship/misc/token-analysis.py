@@ -1,31 +1,26 @@
 import argparse
 import os
-import json
 
 import keyword
 import builtins
 
-from collections import OrderedDict, Counter
+from collections import OrderedDict
 
 import numpy as np
 
+from codeauthorship.dataset.author_usage import AuthorUsage
+from codeauthorship.dataset.corpus import iter_columns
+
 
 def get_dataset(path):
     def read_data():
-        with open(path) as f:
-            for line in f:
-                data = json.loads(line)
-                label = data['username']
-                tokens = data['tokens']
-
-                # Only look at specific token types.
-                tokens = [x for x in tokens if x['type'] == 'NAME']
-
-                ex = {}
-                ex['label'] = label
-                ex['tokens'] = [x['val'] for x in tokens]
+        # Only look at specific token types.
+        for data in iter_columns(path, keep_types={'NAME'}):
+            ex = {}
+            ex['label'] = data['username']
+            ex['tokens'] = data['vals']
 
-                yield ex
+            yield ex
     records = list(read_data())
 
     labels = [x['label'] for x in records]
@@ -46,21 +41,33 @@ def get_reserved_words():
     return set(reserved_words)
 
 
+def get_author_usage(dataset):
+    """
+    Returns the token-by-author usage, a function from token to its count
+    and a function from token to the number of authors that use it.
+    """
+    author_usage, vocab = AuthorUsage.from_lists(dataset['tokens'], dataset['labels'])
+    token_counts = author_usage.token_counts()
+
+    def count_token(token):
+        idx = vocab.value2idx.get(token)
+        return 0 if idx is None else int(token_counts[idx])
+
+    def count_token_author_usage(token):
+        idx = vocab.value2idx.get(token)
+        return 0 if idx is None else author_usage.usage(idx)
+
+    return author_usage, vocab, count_token, count_token_author_usage
+
+
 def run_show_reserved(options):
     reserved_words = get_reserved_words()
     dataset = get_dataset(options.path_in)
 
-    author2token_counter = {}
-    token_counter = Counter()
-
-    for x, y in zip(dataset['tokens'], dataset['labels']):
-        token_counter.update(x)
-        if y not in author2token_counter:
-            author2token_counter[y] = Counter()
-        author2token_counter[y].update(x)
+    author_usage, vocab, count_token, count_token_author_usage = get_author_usage(dataset)
 
-    total_tokens = sum(token_counter.values())
-    total_reserved = sum([token_counter[x] for x in reserved_words])
+    total_tokens = int(author_usage.token_counts().sum())
+    total_reserved = sum([count_token(x) for x in reserved_words])
 
     # About 25% of the data is for reserved tokens. What are the others?
     # print('reserved={:.3f} ({}/{})'.format(
@@ -70,17 +77,14 @@ def run_show_reserved(options):
     # Questions:
     # - How are these tokens distributed among authors?
 
-    def count_token_author_usage(token, author2token_counter):
-        return sum([1 if counter[token] > 0 else 0 for counter in author2token_counter.values()])
-
     reserved = list(reserved_words)
-    counts = [token_counter[x] for x in reserved]
+    counts = [count_token(x) for x in reserved]
     index = np.argsort(counts)[::-1]
 
     for i, idx in enumerate(index):
         val = reserved[idx]
         count = counts[idx]
-        usage = count_token_author_usage(val, author2token_counter)
+        usage = count_token_author_usage(val)
         print('{},{},{},{}'.format(i, val, count, usage))
 
 
@@ -88,17 +92,11 @@ def run_show_unreserved(options):
     reserved_words = get_reserved_words()
     dataset = get_dataset(options.path_in)
 
-    author2token_counter = {}
-    token_counter = Counter()
-
-    for x, y in zip(dataset['tokens'], dataset['labels']):
-        token_counter.update(x)
-        if y not in author2token_counter:
-            author2token_counter[y] = Counter()
-        author2token_counter[y].update(x)
+    author_usage, vocab, count_token, count_token_author_usage = get_author_usage(dataset)
+    token_counts = author_usage.token_counts()
 
-    total_tokens = sum(token_counter.values())
-    total_reserved = sum([token_counter[x] for x in reserved_words])
+    total_tokens = int(token_counts.sum())
+    total_reserved = sum([count_token(x) for x in reserved_words])
 
     # About 25% of the data is for reserved tokens. What are the others?
     # print('reserved={:.3f} ({}/{})'.format(
@@ -108,16 +106,16 @@ def run_show_unreserved(options):
     # Questions:
     # - How are these tokens distributed among authors?
 
-    def count_token_author_usage(token, author2token_counter):
-        return sum([1 if counter[token] > 0 else 0 for counter in author2token_counter.values()])
+    # Most common first. Ties keep first-seen order, as Counter.most_common does.
+    most_common = np.argsort(-token_counts, kind='stable')
 
     seen = 0
     tosee = 100
-    for x in token_counter.most_common():
-        val, count = x
+    for idx in most_common.tolist():
+        val, count = vocab[idx], int(token_counts[idx])
         if val in reserved_words:
             continue
-        usage = count_token_author_usage(val, author2token_counter)
+        usage = author_usage.usage(idx)
         print('{},{},{},{}'.format(seen, val, count, usage))
         seen += 1
 
@@ -13,7 +13,6 @@ from collections import Counter
 import numpy as np
 
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.model_selection import StratifiedKFold
 
 import matplotlib
@@ -21,8 +20,9 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from matplotlib import transforms
 
+from codeauthorship.dataset.sampling import balanced_sample
 from codeauthorship.scripts.train_baseline import run_train
-from codeauthorship.scripts.train_baseline import get_dataset, get_reserved_words
+from codeauthorship.scripts.train_baseline import get_dataset, get_reserved_words, get_tfidf
 from codeauthorship.scripts.train_baseline import get_argument_parser, parse_args
 
 
@@ -115,10 +115,8 @@ def run(options):
     idx2label = {v: k for k, v in label2idx.items()}
     labels = dataset['secondary']['labels']
 
-    contents = [' '.join(x) for x in dataset['primary']]
-
-    vectorizer = TfidfVectorizer()
-    X = vectorizer.fit_transform(contents).toarray()
+    vectorizer, X = get_tfidf(dataset, options)
+    X = X.toarray()
     Y = np.array(labels)
 
     Xargsort = np.argsort(X, axis=0)
@@ -139,16 +137,8 @@ def run(options):
     # Filter to classes with at least 9 instances (and balance labels).
 
     ## First record 9 instances from each class (ignore classes with less than 9 instances).
-    index = np.arange(Y.shape[0])
-    index_to_keep = []
-    label_set = set(labels)
-    for label in label_set:
-        mask = Y == label
-        if mask.sum() < options.cutoff:
-            continue
-        # TODO: Should we take all of the instances?
-        index_to_keep += index[mask].tolist()[:options.cutoff]
-    index_to_keep = np.array(index_to_keep)
+    # TODO: Should we take all of the instances?
+    index_to_keep = balanced_sample(Y, options.cutoff)
 
     ## Then filter accordingly.
     X = X[index_to_keep]
@@ -0,0 +1,232 @@
+"""
+A trained RandomForestClassifier flattened into contiguous arrays, with batch
+prediction over CSR features.
+
+The nodes of every tree are concatenated into one set of arrays (feature,
+threshold, left and right child), and each leaf keeps only the nonzero entries
+of its class distribution (`leaf_ptr`, `leaf_classes`, `leaf_values`), already
+normalized the way the tree's predict_proba normalizes it. Depending on the
+sklearn version, trees store class fractions or weighted counts; which one is
+read off the leaves themselves (fractions sum to 1).
+
+`apply` walks all trees for all rows at once: every (row, tree) pair is one
+entry of an array of current nodes, and each step moves the pairs that are not
+at a leaf down one level, looking their feature up in the CSR row with a
+single searchsorted. `predict_topk` then adds up the sparse leaf distributions
+of each row, in tree order, and keeps the k most probable classes, so a row of
+probabilities over all classes is never built. The sums are done in tree
+order, so the probabilities equal model.predict_proba up to float rounding:
+exactly when the model predicts with n_jobs=1, while with more jobs sklearn
+adds the trees in whichever order its threads finish. Ties go to the lower
+class index as in model.predict.
+"""
+
+import numpy as np
+
+from scipy import sparse
+
+
+TREE_LEAF = -1
+
+
+class FlatForest(object):
+    def __init__(self, feature, threshold, left, right, roots, leaf_ptr, leaf_classes, leaf_values, classes,
+                 n_features):
+        super(FlatForest, self).__init__()
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.roots = roots
+        self.leaf_ptr = leaf_ptr
+        self.leaf_classes = leaf_classes
+        self.leaf_values = leaf_values
+        self.classes = classes
+        self.n_features = n_features
+
+    @property
+    def n_estimators(self):
+        return len(self.roots)
+
+    @property
+    def n_classes(self):
+        return len(self.classes)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        if model.n_outputs_ != 1:
+            raise ValueError('Only single output forests are supported.')
+        n_classes = len(model.classes_)
+
+        feature, threshold, left, right, roots, counts, leaf_classes, leaf_values = [], [], [], [], [], [], [], []
+        offset = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == TREE_LEAF
+
+            feature.append(tree.feature)
+            threshold.append(tree.threshold)
+            left.append(np.where(is_leaf, TREE_LEAF, tree.children_left + offset))
+            right.append(np.where(is_leaf, TREE_LEAF, tree.children_right + offset))
+            roots.append(offset)
+
+            # As DecisionTreeClassifier.predict_proba. Leaves that hold class
+            # fractions are returned as they are, weighted counts are normalized.
+            proba = tree.value.reshape(tree.node_count, -1)[is_leaf][:, :n_classes]
+            normalizer = proba.sum(axis=1)[:, np.newaxis]
+            if not np.allclose(normalizer, 1.0):
+                normalizer[normalizer == 0.0] = 1.0
+                proba /= normalizer
+
+            leaf_rows, leaf_cols = np.nonzero(proba)
+            node_counts = np.zeros(tree.node_count, dtype=np.int64)
+            node_counts[is_leaf] = np.bincount(leaf_rows, minlength=is_leaf.sum())
+            counts.append(node_counts)
+            leaf_classes.append(leaf_cols)
+            leaf_values.append(proba[leaf_rows, leaf_cols])
+
+            offset += tree.node_count
+
+        leaf_ptr = np.zeros(offset + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(counts), out=leaf_ptr[1:])
+
+        return cls(
+            feature=np.concatenate(feature).astype(np.int32),
+            threshold=np.concatenate(threshold).astype(np.float64),
+            left=np.concatenate(left).astype(np.int64),
+            right=np.concatenate(right).astype(np.int64),
+            roots=np.array(roots, dtype=np.int64),
+            leaf_ptr=leaf_ptr,
+            leaf_classes=np.concatenate(leaf_classes).astype(np.int32),
+            leaf_values=np.concatenate(leaf_values).astype(np.float64),
+            classes=np.asarray(model.classes_),
+            n_features=model.n_features_in_ if hasattr(model, 'n_features_in_') else model.n_features_,
+            )
+
+    def save(self, path):
+        np.savez(path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                 roots=self.roots, leaf_ptr=self.leaf_ptr, leaf_classes=self.leaf_classes,
+                 leaf_values=self.leaf_values, classes=self.classes,
+                 n_features=np.array(self.n_features, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            arrays = {k: f[k] for k in f.files}
+        arrays['n_features'] = int(arrays['n_features'])
+        return cls(**arrays)
+
+    def check_input(self, X):
+        """
+        X as float32 CSR with sorted indices and no duplicates, the values
+        sklearn's trees compare against the thresholds.
+        """
+        X = sparse.csr_matrix(X, dtype=np.float32)
+        if X.shape[1] != self.n_features:
+            raise ValueError('X has {} features, but the forest was trained with {}.'.format(
+                X.shape[1], self.n_features))
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        return X
+
+    def apply(self, X):
+        """
+        Global leaf index of every row in every tree, shape (n_rows, n_estimators).
+        """
+        X = self.check_input(X)
+        n_rows, n_trees = X.shape[0], self.n_estimators
+
+        # Rows are sorted and indices are sorted within rows, so these are sorted.
+        keys = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(X.indptr)) * self.n_features + X.indices
+        data = X.data
+
+        # Pair row * n_trees + tree, at node `nodes`.
+        leaves = np.empty(n_rows * n_trees, dtype=np.int64)
+        pairs = np.arange(n_rows * n_trees, dtype=np.int64)
+        nodes = np.tile(self.roots, n_rows)
+        while len(pairs) > 0:
+            done = self.left[nodes] == TREE_LEAF
+            leaves[pairs[done]] = nodes[done]
+            pairs, nodes = pairs[~done], nodes[~done]
+            if len(pairs) == 0:
+                break
+
+            target = (pairs // n_trees) * self.n_features + self.feature[nodes]
+            value = np.zeros(len(pairs), dtype=np.float32)
+            if len(keys) > 0:
+                pos = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+                found = keys[pos] == target
+                value[found] = data[pos[found]]
+
+            nodes = np.where(value <= self.threshold[nodes], self.left[nodes], self.right[nodes])
+
+        return leaves.reshape(n_rows, n_trees)
+
+    def predict_topk(self, X, k=10, max_buffer=1 << 22):
+        """
+        The k most probable classes of every row, most probable first, and
+        their probabilities, both shape (n_rows, k). Rows are predicted in
+        chunks of at most `max_buffer` (row, tree) pairs.
+        """
+        X = self.check_input(X)
+        k = min(k, self.n_classes)
+        n_rows = X.shape[0]
+        chunk_size = max(1, max_buffer // self.n_estimators)
+
+        top_idx = np.empty((n_rows, k), dtype=np.int64)
+        top_proba = np.empty((n_rows, k), dtype=np.float64)
+        for start in range(0, n_rows, chunk_size):
+            idx, proba = self.topk_chunk(X[start:start+chunk_size], k)
+            top_idx[start:start+chunk_size] = idx
+            top_proba[start:start+chunk_size] = proba
+
+        return self.classes.take(top_idx), top_proba
+
+    def topk_chunk(self, X, k):
+        n_rows, n_trees, n_classes = X.shape[0], self.n_estimators, self.n_classes
+        leaves = self.apply(X).ravel()
+
+        # The nonzero leaf entries of each row, tree by tree.
+        counts = self.leaf_ptr[leaves + 1] - self.leaf_ptr[leaves]
+        ends = np.cumsum(counts)
+        entries = np.repeat(self.leaf_ptr[leaves] - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+        rows = np.repeat(np.arange(n_rows * n_trees, dtype=np.int64) // n_trees, counts)
+
+        # Sum per (row, class). np.add.at adds in order, so each sum is
+        # 0 + tree 0 + tree 1 + ..., as RandomForestClassifier.predict_proba.
+        keys, inverse = np.unique(rows * n_classes + self.leaf_classes[entries], return_inverse=True)
+        proba = np.zeros(len(keys), dtype=np.float64)
+        np.add.at(proba, inverse.ravel(), self.leaf_values[entries])
+        proba /= n_trees
+        key_rows, key_classes = keys // n_classes, keys % n_classes
+
+        # Within each row, by probability and then class index.
+        order = np.lexsort((key_classes, -proba, key_rows))
+        row_starts = np.searchsorted(key_rows, np.arange(n_rows))
+        rank = np.arange(len(keys)) - row_starts[key_rows[order]]
+        keep = order[rank < k]
+
+        top_idx = np.empty((n_rows, k), dtype=np.int64)
+        top_proba = np.zeros((n_rows, k), dtype=np.float64)
+        top_idx[key_rows[keep], rank[rank < k]] = key_classes[keep]
+        top_proba[key_rows[keep], rank[rank < k]] = proba[keep]
+
+        # Rows with fewer than k nonzero classes are filled with the lowest
+        # zero probability classes, which are among the first 2k.
+        n_found = np.bincount(key_rows, minlength=n_rows)
+        short = np.flatnonzero(n_found < k)
+        if len(short) > 0:
+            candidates = np.arange(min(2 * k, n_classes))
+            target = short[:, None] * n_classes + candidates[None, :]
+            pos = np.minimum(np.searchsorted(keys, target), max(len(keys) - 1, 0))
+            zero = keys[pos] != target if len(keys) > 0 else np.ones(target.shape, dtype=bool)
+            slot = n_found[short][:, None] + np.cumsum(zero, axis=1) - 1
+            fill = zero & (slot < k)
+            top_idx[np.broadcast_to(short[:, None], fill.shape)[fill], slot[fill]] = \
+                np.broadcast_to(candidates, fill.shape)[fill]
+
+        return top_idx, top_proba
+
+    def predict(self, X):
+        return self.predict_topk(X, k=1)[0][:, 0]
@@ -23,6 +23,8 @@ import torch.utils.data
 
 from tqdm import tqdm
 
+from codeauthorship.utils.fileio import open_file
+
 
 formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
 logger = logging.getLogger('code-authorship')
@@ -51,7 +53,7 @@ class Dataset(object):
         labels = []
 
         # Read file.
-        with open(self.path) as f:
+        with open_file(self.path) as f:
             for i, line in tqdm(enumerate(f), desc='read'):
                 data = json.loads(line)
                 example_ids.append(i)
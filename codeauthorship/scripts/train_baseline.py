@@ -15,9 +15,22 @@ import numpy as np
 from tqdm import tqdm
 
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.model_selection import StratifiedKFold
 
+from codeauthorship.dataset.author_usage import AuthorUsage
+from codeauthorship.dataset.corpus import iter_columns
+from codeauthorship.dataset.encoding import SequenceBuilder, Vocab
+from codeauthorship.dataset.featurizing import TokenTfidfVectorizer
+from codeauthorship.dataset.sampling import balanced_sample
+from codeauthorship.dataset.stages import load_sequences, save_sequences
+from codeauthorship.utils.cache import StageCache, fingerprint, get_random_state, load_csr, make_key, save_csr, set_random_state
+
+
+# Options that only affect training, so are not part of the features' cache key.
+TRAIN_OPTIONS = ('json_result', 'name', 'seed', 'cutoff', 'include_feature_importance', 'cache_dir', 'cache_max_mb')
+# Options that are only read by get_tfidf.
+VECTORIZE_OPTIONS = ('max_features', 'exact_tokens')
+
 
 def get_reserved_words():
     reserved_words = []
@@ -34,9 +47,9 @@ class ObfuscationAlgorithm(object):
         self.rand_vocab = ['rand_vocab_{}'.format(i) for i in range(rand_vocab_size)]
         self.rand_vocab_size = rand_vocab_size
 
-    def obfuscate(self, tokens):
+    def obfuscate(self, types, vals):
         # Get all NAME tokens that are not in the reserved vocab.
-        local_vocab = set([x['val'] for x in tokens if x['type'] == 'NAME' and x['val'] not in self.reserved_words])
+        local_vocab = set([v for t, v in zip(types, vals) if t == 'NAME' and v not in self.reserved_words])
         local_vocab_size = len(local_vocab)
 
         # Create a mapping from the local vocab to our randomized vocab.
@@ -44,16 +57,8 @@ class ObfuscationAlgorithm(object):
         local2rand = {local: self.rand_vocab[index[i]] for i, local in enumerate(local_vocab)}
 
         # Map the tokens.
-        def map_tokens(tokens, mapping):
-            for x in tokens:
-                if x['type'] == 'NAME' and x['val'] not in self.reserved_words:
-                    new_x = {'val': mapping[x['val']], 'type': x['type']}
-                    yield new_x
-                    continue
-                yield x
-        new_tokens = map_tokens(tokens, mapping=local2rand)
-
-        return new_tokens
+        return [local2rand[v] if t == 'NAME' and v not in self.reserved_words else v
+                for t, v in zip(types, vals)]
 
 
 def indexify(value2idx, lst):
@@ -90,9 +95,6 @@ def get_dataset(path, options):
 
     # Read data.
     type_counter = Counter()
-    token_counter = Counter()
-    author2token_counter = {}
-    token2authors = {}
 
     tokens_to_ignore = []
 
@@ -123,55 +125,47 @@ def get_dataset(path, options):
 
     reserved_words = get_reserved_words()
 
-    count_token_author_usage_cache = {}
     def count_token_author_usage(token):
-        if token not in count_token_author_usage_cache:
-            count_token_author_usage_cache[token] = sum(
-                [1 if counter[token] > 0 else 0 for counter in author2token_counter.values()])
-        return count_token_author_usage_cache[token]
+        # Usage is over lowercased values, but looked up with the original value.
+        idx = usage_vocab.value2idx.get(token)
+        return 0 if idx is None else author_usage.usage(idx)
+
+    def select(types, vals, keep):
+        index = [i for i in range(len(types)) if keep(types[i], vals[i])]
+        return [types[i] for i in index], [vals[i] for i in index]
 
-    def get_tokens(tokens):
-        xs = [x for x in tokens if x['type'] not in tokens_to_ignore]
+    def get_tokens(types, vals):
+        types, vals = select(types, vals, lambda t, v: t not in tokens_to_ignore)
         # There should always be at least two tokens.
-        while len(xs) <= 1:
-            xs.append({'val': 'FILLER', 'type': 'FILLER'})
+        while len(types) <= 1:
+            types.append('FILLER')
+            vals.append('FILLER')
         # Optionally, obfuscate the tokens.
         if options.noreserved:
-            xs = [x for x in xs if x['type'] != 'NAME'
-                    or (x['type'] == 'NAME' and x['val'] not in reserved_words)]
+            types, vals = select(types, vals, lambda t, v: t != 'NAME' or v not in reserved_words)
         if options.onlyreserved:
-            xs = [x for x in xs if x['type'] != 'NAME'
-                    or (x['type'] == 'NAME' and x['val'] in reserved_words)]
+            types, vals = select(types, vals, lambda t, v: t != 'NAME' or v in reserved_words)
         if options.obfuscate_names:
-            xs = obfuscate.obfuscate(xs)
+            vals = obfuscate.obfuscate(types, vals)
         if options.minthreshold_author > 0:
-            xs = [x for x in xs if x['type'] != 'NAME'
-                    or (x['type'] == 'NAME' and count_token_author_usage(x['val']) > options.minthreshold_author)]
-        return xs
-
-    # Read data once to build a vocab.
-    def readall():
-        with open(path) as f:
-            for i, line in enumerate(f):
-                ex = json.loads(line)
-                yield ex
+            types, vals = select(types, vals,
+                                 lambda t, v: t != 'NAME' or count_token_author_usage(v) > options.minthreshold_author)
+        return types, vals
 
-    raw_data = list(readall())
+    # Tokens come as parallel type and value lists, read straight from the id
+    # arrays of a binary corpus.
+    raw_data = list(iter_columns(path))
 
-    for i, ex in enumerate(raw_data):
-        tokens = ex['tokens']
-        label = ex['username']
-        token_vals = [x['val'].lower() for x in tokens if x['type'] == 'NAME']
-        token_counter.update(token_vals)
-        if label not in author2token_counter:
-            author2token_counter[label] = Counter()
-        author2token_counter[label].update(token_vals)
+    # Count how many authors use each NAME token.
+    if options.minthreshold_author > 0:
+        author_usage, usage_vocab = AuthorUsage.from_lists(
+            ([v.lower() for t, v in zip(ex['types'], ex['vals']) if t == 'NAME'] for ex in raw_data),
+            [ex['username'] for ex in raw_data])
 
     # Read again!
     for i, ex in enumerate(raw_data):
-        tokens = get_tokens(ex['tokens'])
-        token_vals = [x['val'].lower() for x in tokens]
-        token_types = [x['type'] for x in tokens]
+        token_types, token_vals = get_tokens(ex['types'], ex['vals'])
+        token_vals = [x.lower() for x in token_vals]
         type_counter.update(token_types)
 
         seq.append(token_vals)
@@ -218,6 +212,101 @@ def get_dataset(path, options):
     return dataset
 
 
+def encode_dataset(dataset):
+    vocab = Vocab()
+    seq = SequenceBuilder(vocab)
+    for x in dataset['primary']:
+        seq.add(x)
+    return vocab, seq.build()
+
+
+def vectorize(vocab, seqs, options, max_features=None):
+    vectorizer = TokenTfidfVectorizer(vocab, max_features=max_features, exact=options.exact_tokens)
+    X = vectorizer.fit_transform(seqs)
+    return vectorizer, X
+
+
+def get_tfidf(dataset, options, max_features=None):
+    """
+    TF-IDF over the token sequences of a dataset from get_dataset. The tokens
+    are encoded to ids and counted directly (see TokenTfidfVectorizer), rather
+    than joined into strings and re-tokenized.
+    """
+    vocab, seqs = encode_dataset(dataset)
+    return vectorize(vocab, seqs, options, max_features=max_features)
+
+
+def get_metadata(dataset):
+    return {k: dataset['metadata'][k] for k in ('dataset_size', 'vocab_size', 'n_classes')}
+
+
+def get_stage_keys(options):
+    read_options = {k: v for k, v in options.__dict__.items() if k not in TRAIN_OPTIONS + VECTORIZE_OPTIONS}
+    if options.obfuscate_names:
+        # Names are obfuscated at random.
+        read_options['seed'] = options.seed
+    read_key = make_key('read', fingerprint(options.path_in), read_options)
+    vectorize_key = make_key('vectorize', read_key, {k: getattr(options, k) for k in VECTORIZE_OPTIONS})
+    return read_key, vectorize_key
+
+
+def get_features(options):
+    """
+    get_dataset followed by get_tfidf. Returns (metadata, X, Y).
+
+    With --cache_dir, each stage is cached as in dataset/stages.py: the encoded
+    dataset is keyed by the input file and the options get_dataset reads, and
+    the features by that key and the vectorizer options. Changing only
+    --max_features or --exact_tokens reuses the dataset.
+    """
+    if options.cache_dir is None:
+        dataset = get_dataset(options.path_in, options)
+        vectorizer, X = get_tfidf(dataset, options, max_features=options.max_features)
+        return get_metadata(dataset), X, np.array(dataset['secondary']['labels'])
+
+    max_bytes = options.cache_max_mb << 20 if options.cache_max_mb is not None else None
+    cache = StageCache(options.cache_dir, max_bytes=max_bytes)
+    read_key, vectorize_key = get_stage_keys(options)
+
+    hit = cache.get('vectorize', vectorize_key)
+    if hit is not None:
+        print('loaded features from cache')
+        arrays, meta = hit
+        if meta['random_state'] is not None:
+            set_random_state(meta['random_state'])
+        return meta['metadata'], load_csr(arrays, 'X'), arrays['Y']
+
+    hit = cache.get('read', read_key)
+    if hit is not None:
+        print('loaded dataset from cache')
+        arrays, meta = hit
+        random_state = meta['random_state']
+        if random_state is not None:
+            set_random_state(random_state)
+        metadata = meta['metadata']
+        vocab = Vocab(meta['vocab'])
+        seqs = load_sequences(arrays, 'seq')
+        Y = arrays['Y']
+    else:
+        dataset = get_dataset(options.path_in, options)
+        metadata = get_metadata(dataset)
+        vocab, seqs = encode_dataset(dataset)
+        Y = np.array(dataset['secondary']['labels'])
+        random_state = get_random_state() if options.obfuscate_names else None
+
+        arrays = {'Y': Y}
+        save_sequences(arrays, 'seq', seqs)
+        cache.put('read', read_key, arrays, {'metadata': metadata, 'vocab': vocab.values, 'random_state': random_state})
+
+    vectorizer, X = vectorize(vocab, seqs, options, max_features=options.max_features)
+
+    arrays = {'Y': Y}
+    save_csr(arrays, 'X', X)
+    cache.put('vectorize', vectorize_key, arrays, {'metadata': metadata, 'random_state': random_state})
+
+    return metadata, X, Y
+
+
 def run_train(X, Y):
     model = RandomForestClassifier(n_estimators=100, max_depth=None, n_jobs=-1, random_state=0)
     model.fit(X, Y)
@@ -283,21 +372,11 @@ def run_experiment(trainX, trainY, testX, testY):
 def run(options):
     random.seed(options.seed)
     np.random.seed(options.seed)
-    dataset = get_dataset(options.path_in, options)
+    metadata, X, Y = get_features(options)
 
-    print('dataset-size = {}'.format(dataset['metadata']['dataset_size']))
-    print('vocab-size = {}'.format(dataset['metadata']['vocab_size']))
-    print('# of classes = {}'.format(dataset['metadata']['n_classes']))
-
-    label2idx = dataset['metadata']['label2idx']
-    idx2label = {v: k for k, v in label2idx.items()}
-    labels = dataset['secondary']['labels']
-
-    contents = [' '.join(x) for x in dataset['primary']]
-
-    vectorizer = TfidfVectorizer(max_features=options.max_features)
-    X = vectorizer.fit_transform(contents)
-    Y = np.array(labels)
+    print('dataset-size = {}'.format(metadata['dataset_size']))
+    print('vocab-size = {}'.format(metadata['vocab_size']))
+    print('# of classes = {}'.format(metadata['n_classes']))
 
     # Shuffle.
     index = np.arange(Y.shape[0])
@@ -308,16 +387,8 @@ def run(options):
     # Filter to classes with at least 9 instances (and balance labels).
 
     ## First record 9 instances from each class (ignore classes with less than 9 instances).
-    index = np.arange(Y.shape[0])
-    index_to_keep = []
-    label_set = set(labels)
-    for label in label_set:
-        mask = Y == label
-        if mask.sum() < options.cutoff:
-            continue
-        # TODO: Should we take all of the instances?
-        index_to_keep += index[mask].tolist()[:options.cutoff]
-    index_to_keep = np.array(index_to_keep)
+    # TODO: Should we take all of the instances?
+    index_to_keep = balanced_sample(Y, options.cutoff)
 
     ## Then filter accordingly.
     X = X[index_to_keep]
@@ -370,10 +441,7 @@ def run_feature_importance(options):
     idx2label = {v: k for k, v in label2idx.items()}
     labels = dataset['secondary']['labels']
 
-    contents = [' '.join(x) for x in dataset['primary']]
-
-    vectorizer = TfidfVectorizer(max_features=options.max_features)
-    X = vectorizer.fit_transform(contents)
+    vectorizer, X = get_tfidf(dataset, options, max_features=options.max_features)
     Y = np.array(labels)
 
     # Shuffle.
@@ -385,16 +453,8 @@ def run_feature_importance(options):
     # Filter to classes with at least 9 instances (and balance labels).
 
     ## First record 9 instances from each class (ignore classes with less than 9 instances).
-    index = np.arange(Y.shape[0])
-    index_to_keep = []
-    label_set = set(labels)
-    for label in label_set:
-        mask = Y == label
-        if mask.sum() < options.cutoff:
-            continue
-        # TODO: Should we take all of the instances?
-        index_to_keep += index[mask].tolist()[:options.cutoff]
-    index_to_keep = np.array(index_to_keep)
+    # TODO: Should we take all of the instances?
+    index_to_keep = balanced_sample(Y, options.cutoff)
 
     ## Then filter accordingly.
     X = X[index_to_keep]
@@ -429,13 +489,9 @@ def run_feature_importance(options):
     word2idx = vectorizer.vocabulary_
     idx2word = {v: k for k, v in word2idx.items()}
 
-    token_counter = Counter()
-    token2authors = {}
-    for i, seq in enumerate(dataset['primary']):
-        label = labels[i]
-        token_counter.update(seq)
-        for x in seq:
-            token2authors.setdefault(x, set()).add(label)
+    author_usage, usage_vocab = AuthorUsage.from_lists(dataset['primary'], labels)
+    token2idx = dict(usage_vocab.value2idx)
+    token_counts = author_usage.token_counts()
 
     # Feature importance
     fi_lst = model.feature_importances_.tolist()
@@ -446,16 +502,15 @@ def run_feature_importance(options):
     # More.
     token_authorcount = {}
     for k in feature_importance.keys():
-        if k not in token2authors:
-            if k[2:] in token2authors:
+        if k not in token2idx:
+            if k[2:] in token2idx:
                 k = k[2:]
-            elif k[:-2] in token2authors:
+            elif k[:-2] in token2idx:
                 k = k[:-2]
-            elif k[2:-2] in token2authors:
+            elif k[2:-2] in token2idx:
                 k = k[2:-2]
-        token_authorcount[k] = len(token2authors[k])
-    # k: len(token2authors[k]) for k in feature_importance.keys()}
-    token_count = {k: token_counter[k] for k in feature_importance.keys()}
+        token_authorcount[k] = author_usage.usage(token2idx[k])
+    token_count = {k: int(token_counts[token2idx[k]]) if k in token2idx else 0 for k in feature_importance.keys()}
 
     if options.json_result:
         json_result = {}
@@ -477,6 +532,8 @@ def get_argument_parser():
     parser.add_argument('--path_in', default='~/Downloads/gcj-small.jsonl', type=str)
     parser.add_argument('--seed', default=None, type=int)
     parser.add_argument('--cutoff', default=9, type=int)
+    parser.add_argument('--cache_dir', default=None, type=str)
+    parser.add_argument('--cache_max_mb', default=None, type=int)
     # tokens to ignore
     parser.add_argument('--nocomment', action='store_true')
     parser.add_argument('--nostring', action='store_true')
@@ -509,6 +566,7 @@ def get_argument_parser():
     parser.add_argument('--onlyreserved', action='store_true')
     parser.add_argument('--minthreshold_author', default=0, type=int)
     parser.add_argument('--max_features', default=None, type=int)
+    parser.add_argument('--exact_tokens', action='store_true')
     parser.add_argument('--include_feature_importance', action='store_true')
     
     return parser
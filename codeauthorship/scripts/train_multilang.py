@@ -29,10 +29,16 @@ TODO List
 
 
 import argparse
+import copy
+import multiprocessing
 import os
 import json
 import random
+import resource
+import shutil
 import sys
+import tempfile
+import time
 
 from collections import Counter
 
@@ -43,6 +49,10 @@ from sklearn.model_selection import StratifiedKFold
 
 from codeauthorship.dataset.reading import *
 from codeauthorship.dataset.manager import *
+from codeauthorship.dataset.featurizing import FeatureStore
+from codeauthorship.dataset.stages import build_cached
+from codeauthorship.models.forest import FlatForest
+from codeauthorship.utils.cache import StageCache
 from codeauthorship.utils.logging import *
 
 
@@ -85,39 +95,192 @@ def run_train(options, X, Y):
     return results
 
 
-def run_evaluation(model, X, Y):
-    predictions = model.predict(X)
+def run_evaluation(model, X, Y, k=10, max_buffer=1 << 22, legacy_topk=False):
+    """
+    Accuracy and accuracy at 1..k from a single predict_proba pass, with rows
+    predicted in chunks of at most `max_buffer` probabilities. k is capped at
+    the number of classes.
+
+    Rather than sorting the classes of each row, the rank of the true class is
+    counted directly: the classes more probable than it, plus the equally
+    probable ones with a lower index. That is the order model.predict breaks
+    ties in, so accuracy at 1 is the accuracy. With `legacy_topk`, top-k uses
+    the reversed argsort order of earlier versions instead, so tied classes
+    rank as they did before; the accuracy is the same either way.
+    """
+    n_classes = len(model.classes_)
+    k = min(k, n_classes)
+    # classes_ is sorted, so this is the class index of each label.
+    y_idx = np.minimum(np.searchsorted(model.classes_, Y), n_classes - 1)
+    unseen = model.classes_[y_idx] != Y
+    if unseen.any():
+        raise ValueError('{} labels are not classes of the model, e.g. {}'.format(
+            unseen.sum(), np.asarray(Y)[unseen][0]))
+    chunk_size = max(1, max_buffer // n_classes)
+
+    # hits[j]: rows whose label has rank j, for j < k.
+    hits = np.zeros(k, dtype=np.int64)
+    correct = 0
+    for start in range(0, X.shape[0], chunk_size):
+        prob = model.predict_proba(X[start:start+chunk_size])
+        y = y_idx[start:start+chunk_size]
+
+        if legacy_topk:
+            # argmax takes the lowest index on ties, as model.predict does.
+            correct += np.sum(np.argmax(prob, axis=1) == y)
+            pred = np.argsort(prob, axis=1)[:, ::-1][:, :k]
+            rank = np.where(pred == y[:, None], np.arange(k)[None, :], k).min(axis=1)
+        else:
+            p_y = prob[np.arange(len(y)), y][:, None]
+            lower = np.arange(n_classes)[None, :] < y[:, None]
+            rank = np.sum(prob > p_y, axis=1) + np.sum((prob == p_y) & lower, axis=1)
+            correct += np.sum(rank == 0)
+        hits += np.bincount(rank[rank < k], minlength=k)
 
-    # Accuracy
-    acc = np.mean(predictions == Y)
+    n = X.shape[0]
+    cumulative = np.cumsum(hits)
+
+    # Accuracy at k.
+    acck = {}
+    for kk in range(1, k+1):
+        acck[kk] = cumulative[kk-1] / n
 
     results = {}
-    results['acc'] = acc
+    results['acc'] = correct / n
+    results['acck'] = acck
     return results
 
 
-def run_evaluation_topk(model, X, Y, k=10):
-    class2idx = {k: i for i, k in enumerate(model.classes_.tolist())}
-    y_idx = [class2idx[k] for k in Y.tolist()]
-    # Reshape so it is one class per row.
-    y_idx = np.array(y_idx).repeat(k).reshape(-1, k)
+def run_evaluation_flat(forest, X, Y, k=10):
+    """
+    As run_evaluation, with a FlatForest. Its top-k classes are ordered by
+    probability and then class index, so the rank of the true class is its
+    position among them.
+    """
+    unseen = ~np.isin(Y, forest.classes)
+    if unseen.any():
+        raise ValueError('{} labels are not classes of the model, e.g. {}'.format(
+            unseen.sum(), np.asarray(Y)[unseen][0]))
+
+    # k is capped at the number of classes.
+    top, _ = forest.predict_topk(X, k=k)
+    k = top.shape[1]
+    match = top == np.asarray(Y)[:, None]
 
-    prob = model.predict_proba(X)
-    pred = np.argsort(prob, axis=1)[:, ::-1][:, :k]
+    n = X.shape[0]
+    cumulative = np.cumsum(match.sum(axis=0))
 
-    # Compute accuracy at k.
+    # Accuracy at k.
     acck = {}
     for kk in range(1, k+1):
-        pred_topk = pred[:, :kk]
-        y_idx_k = y_idx[:, :kk]
-        acck[kk] = np.sum(pred_topk == y_idx_k, axis=1).mean()
+        acck[kk] = cumulative[kk-1] / n
 
     results = {}
+    results['acc'] = acck[1]
     results['acck'] = acck
+    return results
+
+
+def run_fold(options, store, Y, train_index, test_index):
+    logger = get_logger()
+
+    start = time.time()
+    trainX, testX = store.train(train_index), store.test(test_index)
+    trainY, testY = Y[train_index], Y[test_index]
+    logger.info('setup-time={:.3f}s'.format(time.time() - start))
+
+    # Train
+    logger.info('train')
+    train_results = run_train(options, trainX, trainY)
+    model = train_results['model']
+
+    depths = [a.tree_.max_depth for a in model.estimators_]
+    logger.info('depths = {}'.format(depths))
+
+    leaf_node_counts = [int(get_leaf_node_count(a)) for a in model.estimators_]
+    logger.info('leaf-node-counts = {}'.format(leaf_node_counts))
+
+    # Eval
+    logger.info('eval')
+    start = time.time()
+    if options.flat_forest:
+        forest = FlatForest.from_sklearn(model)
+        logger.info('flat-forest nodes={} leaf-entries={}'.format(len(forest.feature), len(forest.leaf_values)))
+        eval_results = run_evaluation_flat(forest, testX, testY)
+    else:
+        eval_results = run_evaluation(model, testX, testY, legacy_topk=options.legacy_topk)
+    logger.info('eval-time={:.3f}s'.format(time.time() - start))
+    acc = eval_results['acc']
+    logger.info('eval-acc={:.3f}'.format(acc))
+
+    for k, v in eval_results['acck'].items():
+        logger.info('k={} eval-acc={:.3f}'.format(k, v))
+
+    results = {}
+    results['acc'] = acc
+    results['acck'] = eval_results['acck']
+    results['train_size'] = trainX.shape[0]
+    results['test_size'] = testX.shape[0]
+
+    del model
 
     return results
 
 
+# Set in each worker of run_folds_parallel.
+_fold_data = None
+
+
+def _init_fold_worker(path, Y):
+    global _fold_data
+    arrays = {name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r') for name in os.listdir(path)}
+    _fold_data = (FeatureStore.load(arrays), Y)
+
+
+def _run_fold_task(args):
+    options, i, train_index, test_index = args
+    logger = get_logger()
+    logger.info('fold {}'.format(i))
+    store, Y = _fold_data
+    return run_fold(options, store, Y, train_index, test_index)
+
+
+def run_folds_parallel(options, store, Y, splits, fold_jobs):
+    """
+    Run folds in a process pool. The feature store is written once to
+    memory-mapped files that every worker opens, rather than being pickled to
+    each one, and the --n_jobs cores (counted as joblib does, so -1 is every
+    core) are split between folds and the trees of each fold. Results come
+    back in fold order.
+    """
+    logger = get_logger()
+
+    n_cpus = multiprocessing.cpu_count()
+    if options.n_jobs > 0:
+        n_jobs = options.n_jobs
+    else:
+        n_jobs = max(1, n_cpus + 1 + options.n_jobs)
+    fold_options = copy.copy(options)
+    fold_options.n_jobs = max(1, n_jobs // fold_jobs)
+    logger.info('{} folds at a time, n_jobs={} each'.format(fold_jobs, fold_options.n_jobs))
+
+    path = tempfile.mkdtemp(prefix='codeauth-cv-')
+    try:
+        arrays = {}
+        store.save(arrays)
+        size = 0
+        for name, x in arrays.items():
+            np.save(os.path.join(path, '{}.npy'.format(name)), x)
+            size += x.nbytes
+        logger.info('wrote features for fold workers to {} ({:.1f} MB)'.format(path, size / 2**20))
+
+        tasks = [(fold_options, i, train_index, test_index) for i, (train_index, test_index) in enumerate(splits)]
+        with multiprocessing.Pool(fold_jobs, initializer=_init_fold_worker, initargs=(path, Y)) as pool:
+            return pool.map(_run_fold_task, tasks, chunksize=1)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 def run_cv(options, X, Y):
     logger = get_logger()
 
@@ -135,44 +298,37 @@ def run_cv(options, X, Y):
     cross_validation_splitter = StratifiedKFold(n_splits=n_splits)
     splits = cross_validation_splitter.split(X, Y)
 
-    for i in range(n_splits):
-        logger.info('fold {}'.format(i))
-        train_index, test_index = next(splits)
-        trainX, testX = X[train_index], X[test_index]
-        trainY, testY = Y[train_index], Y[test_index]
-
-        # Train
-        logger.info('train')
-        train_results = run_train(options, trainX, trainY)
-        model = train_results['model']
-
-        depths = [a.tree_.max_depth for a in model.estimators_]
-        logger.info('depths = {}'.format(depths))
-
-        leaf_node_counts = [get_leaf_node_count(a) for a in model.estimators_]
-        logger.info('leaf-node-counts = {}'.format(depths))
-
-        # Eval
-        logger.info('eval')
-        eval_results = run_evaluation(model, testX, testY)
-        acc = eval_results['acc']
-        logger.info('eval-acc={:.3f}'.format(acc))
-
-        eval_results = run_evaluation_topk(model, testX, testY)
-        for k, v in eval_results['acck'].items():
-            logger.info('k={} eval-acc={:.3f}'.format(k, v))
+    # Converted once, rather than by every fit and predict.
+    start = time.time()
+    store = FeatureStore(X)
+    logger.info('feature-store-time={:.3f}s'.format(time.time() - start))
+
+    fold_jobs = options.fold_jobs
+    if fold_jobs < 0:
+        fold_jobs = multiprocessing.cpu_count()
+    fold_jobs = min(fold_jobs, n_splits)
+
+    if fold_jobs > 1:
+        fold_results = run_folds_parallel(options, store, Y, splits, fold_jobs)
+    else:
+        fold_results = []
+        for i in range(n_splits):
+            logger.info('fold {}'.format(i))
+            train_index, test_index = next(splits)
+            fold_results.append(run_fold(options, store, Y, train_index, test_index))
+
+    for i, results in enumerate(fold_results):
+        if fold_jobs > 1:
+            logger.info('fold {} eval-acc={:.3f}'.format(i, results['acc']))
+        for k, v in results['acck'].items():
             acck.setdefault(k, []).append(v)
 
-        train_size = trainX.shape[0]
-        test_size = testX.shape[0]
-
         # Record for later.
-        metrics['acc'].append(acc)
-
-        del model
+        metrics['acc'].append(results['acc'])
 
     for k, v in acck.items():
         metrics['acck'][k] = np.mean(v)
+    logger.info('peak-rss={:.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
     results = {}
     results['metrics'] = metrics
     results['metadata'] = metadata
@@ -198,8 +354,20 @@ def get_argument_parser():
     parser.add_argument('--seed', default=None, type=int)
     parser.add_argument('--cutoff', default=9, type=int)
     parser.add_argument('--exact', action='store_true')
+    parser.add_argument('--author_index', action='store_true')
+    parser.add_argument('--cache_dir', default=None, type=str)
+    parser.add_argument('--cache_max_mb', default=None, type=int)
+    parser.add_argument('--read_jobs', default=None, type=int)
+    parser.add_argument('--parse_jobs', default=1, type=int)
+    parser.add_argument('--max_in_flight', default=1024, type=int)
     # data
     parser.add_argument('--max_features', default=None, type=int)
+    parser.add_argument('--exact_tokens', action='store_true')
+    parser.add_argument('--tfidf_chunk_size', default=1 << 18, type=int)
+    parser.add_argument('--tfidf_dir', default=None, type=str)
+    parser.add_argument('--featurizer', default='tfidf', choices=('tfidf', 'hashed'))
+    parser.add_argument('--max_ngram', default=2, type=int)
+    parser.add_argument('--n_hash_features', default=1 << 18, type=int)
     parser.add_argument('--max_classes', default=None, type=int)
     parser.add_argument('--extra_type', action='store_true')
     parser.add_argument('--reserved', action='store_true')
@@ -210,9 +378,12 @@ def get_argument_parser():
     parser.add_argument('--multilang', action='store_true')
     # rfc
     parser.add_argument('--n_jobs', default=-1, type=int)
+    parser.add_argument('--fold_jobs', default=1, type=int)
     parser.add_argument('--n_estimators', default=100, type=int)
     parser.add_argument('--max_depth', default=None, type=int)
     parser.add_argument('--max_leaf_nodes_scale', default=None, type=int)
+    parser.add_argument('--legacy_topk', action='store_true')
+    parser.add_argument('--flat_forest', action='store_true')
     
     return parser
     
@@ -220,6 +391,10 @@ def get_argument_parser():
 def parse_args(parser):
     options = parser.parse_args()
 
+    if options.flat_forest and options.legacy_topk:
+        # The flat forest never builds the full probability rows the old order came from.
+        parser.error('--legacy_topk can not be used with --flat_forest')
+
     if options.preset_py != 'none':
         preset_py = dict(small='~/Downloads/gcj-py-small.jsonl')
         options.path_py = os.path.expanduser(preset_py[options.preset_py])
@@ -246,10 +421,13 @@ def run(options):
 
     random.seed(options.seed)
     np.random.seed(options.seed)
-    raw_datasets = DatasetReader(options).read()
-
     # TODO: Use language as a feature?
-    X, Y, languages = DatasetManager(options).build(raw_datasets)
+    if options.cache_dir is not None:
+        max_bytes = options.cache_max_mb << 20 if options.cache_max_mb is not None else None
+        X, Y, languages = build_cached(options, StageCache(options.cache_dir, max_bytes=max_bytes))
+    else:
+        raw_datasets = DatasetReader(options).read()
+        X, Y, languages = DatasetManager(options).build(raw_datasets)
 
     logger.info('language-counter={}'.format(Counter(languages)))
     logger.info('X.shape={} Y.shape={}'.format(X.shape, Y.shape))
@@ -0,0 +1,141 @@
+"""
+Content-addressed cache for pipeline stage outputs.
+
+Each entry is a directory `<root>/<stage>-<key>` holding one `.npy` file per
+array and a `meta.json` for everything else. The key is a hash of whatever the
+stage's output depends on: fingerprints of the input files and the options the
+stage reads, plus the key of the stage it was computed from. Arrays are opened
+memory-mapped, so loading an entry only reads what is used.
+
+Entries are written to a temporary directory and renamed into place, so a run
+that is interrupted never leaves a partial entry. Every hit touches the entry,
+and after each write the least recently used entries are removed until the
+cache fits in `max_bytes`.
+"""
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from scipy import sparse
+
+
+def fingerprint(path):
+    """
+    Identifies the contents of a file, or of every file in a directory (a
+    binary corpus), by path, size and modification time.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    if os.path.isdir(path):
+        return [fingerprint(os.path.join(path, x)) for x in sorted(os.listdir(path))]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def make_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_random_state():
+    """
+    The state of `random` as JSON, for stages that draw from it.
+    """
+    version, state, gauss = random.getstate()
+    return [version, list(state), gauss]
+
+
+def set_random_state(x):
+    version, state, gauss = x
+    random.setstate((version, tuple(state), gauss))
+
+
+def save_csr(arrays, name, X):
+    X = sparse.csr_matrix(X)
+    arrays[name + '_data'] = X.data
+    arrays[name + '_indices'] = X.indices
+    arrays[name + '_indptr'] = X.indptr
+    arrays[name + '_shape'] = np.array(X.shape, dtype=np.int64)
+
+
+def load_csr(arrays, name):
+    shape = tuple(arrays[name + '_shape'].tolist())
+    return sparse.csr_matrix((arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr']),
+                             shape=shape, copy=False)
+
+
+class StageCache(object):
+    def __init__(self, root, max_bytes=None):
+        super(StageCache, self).__init__()
+        self.root = os.path.expanduser(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def entry_path(self, stage, key):
+        return os.path.join(self.root, '{}-{}'.format(stage, key))
+
+    def get(self, stage, key):
+        """
+        Returns (arrays, meta), or None if there is no entry.
+        """
+        path = self.entry_path(stage, key)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        os.utime(path)
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in meta['arrays']:
+            arrays[name] = np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r')
+        return arrays, meta['meta']
+
+    def put(self, stage, key, arrays, meta):
+        path = self.entry_path(stage, key)
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            for name, x in arrays.items():
+                np.save(os.path.join(tmp_path, '{}.npy'.format(name)), np.asarray(x))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump({'arrays': sorted(arrays.keys()), 'meta': meta}, f)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.evict(keep=path)
+
+    def entries(self):
+        """
+        (last used, size in bytes, path) of every entry.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum([os.path.getsize(os.path.join(path, x)) for x in os.listdir(path)])
+            entries.append((os.path.getmtime(path), size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries (never `keep`) until the cache
+        fits in `max_bytes`.
+        """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
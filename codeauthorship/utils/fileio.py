@@ -0,0 +1,86 @@
+"""
+Open plain or compressed (gzip, bz2, lzma) files.
+
+When reading, the compression is detected from the first bytes of the file, so
+a renamed file still reads correctly. When writing, it is chosen from the
+extension: .gz, .bz2, .xz or .lzma.
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+
+
+MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'lzma'),
+]
+
+EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'lzma',
+    '.lzma': 'lzma',
+}
+
+
+def detect_compression(path):
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def compression_from_extension(path):
+    for ext, compression in EXTENSIONS.items():
+        if path.endswith(ext):
+            return compression
+    return None
+
+
+def wrap_compressed(fileobj, compression, mode):
+    """
+    Wrap an open binary file. Closing the wrapper ends the compressed stream
+    but leaves `fileobj` open, so several streams can be written to one file.
+    """
+    if compression == 'gzip':
+        # Level 6 is ~3x faster to write than the default 9 for a few % in size.
+        return gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=6)
+    if compression == 'bz2':
+        return bz2.BZ2File(fileobj, mode=mode)
+    if compression == 'lzma':
+        return lzma.LZMAFile(fileobj, mode=mode)
+    raise ValueError('unknown compression {}'.format(compression))
+
+
+def open_file(path, mode='r'):
+    """
+    Open a file for reading ('r', 'rb') or writing ('w', 'wb', 'a', 'ab'),
+    transparently (de)compressing it. Text modes use utf-8.
+    """
+    binary = 'b' in mode
+    if mode[0] == 'r':
+        compression = detect_compression(path)
+    else:
+        compression = compression_from_extension(path)
+
+    if compression is None:
+        if binary:
+            return open(path, mode)
+        return open(path, mode, encoding='utf-8')
+
+    bmode = mode.replace('b', '').replace('t', '') + 'b'
+    if compression == 'gzip':
+        f = gzip.open(path, bmode) if bmode == 'rb' else gzip.open(path, bmode, compresslevel=6)
+    elif compression == 'bz2':
+        f = bz2.open(path, bmode)
+    else:
+        f = lzma.open(path, bmode)
+
+    if binary:
+        return f
+    return io.TextIOWrapper(f, encoding='utf-8')
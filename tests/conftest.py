@@ -0,0 +1,72 @@
+import json
+import random
+
+import pytest
+
+from codeauthorship.dataset.corpus import CorpusWriter
+
+
+NAMES = ['print', 'len', 'range', 'if', 'for', 'Foo', 'foo', 'bar', 'x', 'y', 'Zé', 'q"uote', 'back\\slash']
+TYPES = ['NAME', 'NAME', 'NAME', 'OP', 'NUMBER', 'COMMENT', 'STRING', 'NEWLINE']
+
+
+def make_records(seed=0, n_authors=12, min_files=8, max_files=11):
+    """
+    A small corpus in the JSONL layout the converters write. The first file of
+    every author is empty, and names include reserved words, mixed case and
+    characters that JSON escapes.
+    """
+    rng = random.Random(seed)
+
+    def make_token():
+        token_type = rng.choice(TYPES)
+        if token_type == 'NAME':
+            val = rng.choice(NAMES)
+        elif token_type == 'OP':
+            val = rng.choice(['+', '(', ')'])
+        elif token_type == 'NUMBER':
+            val = str(rng.randint(0, 5))
+        else:
+            val = '{}{}'.format(token_type.lower(), rng.randint(0, 3))
+        return {'type': token_type, 'val': val}
+
+    records = []
+    for author in range(n_authors):
+        for i in range(rng.randint(min_files, max_files)):
+            n_tokens = rng.randint(1, 30) if i > 0 else 0
+            ex = {}
+            ex['year'] = str(2008 + author % 3)
+            ex['username'] = 'user{}'.format(author)
+            ex['tokens'] = [make_token() for _ in range(n_tokens)]
+            ex['example_id'] = str(len(records))
+            records.append(ex)
+    return records
+
+
+def write_jsonl(path, records):
+    with open(path, 'w') as f:
+        for ex in records:
+            f.write('{}\n'.format(json.dumps(ex)))
+    return str(path)
+
+
+def write_corpus(path, records):
+    with CorpusWriter(str(path)) as writer:
+        for ex in records:
+            writer.add(ex)
+    return str(path)
+
+
+@pytest.fixture
+def records():
+    return make_records()
+
+
+@pytest.fixture
+def jsonl_path(tmp_path, records):
+    return write_jsonl(tmp_path / 'small.jsonl', records)
+
+
+@pytest.fixture
+def corpus_path(tmp_path, records):
+    return write_corpus(tmp_path / 'small.corpus', records)
@@ -0,0 +1,105 @@
+import csv
+import os
+
+import pytest
+
+from codeauthorship.dataset import converting
+from codeauthorship.dataset.converting import convert_files
+from codeauthorship.utils.fileio import open_file
+
+
+HEADER = ['', 'year', 'round', 'username', 'task', 'solution', 'file', 'full_path', 'flines']
+
+
+def make_rows(n_authors=4, n_tasks=5):
+    rows = []
+    for author in range(n_authors):
+        for task in range(n_tasks):
+            filename = 'sol{}.py'.format(task)
+            source = 'def f{0}(x):\n    return x + {1}  # user{1}\n'.format(task, author)
+            rows.append(['2017', '1', 'user{}'.format(author), str(task), '0', filename,
+                         'user{}/{}'.format(author, filename), source])
+        # A file that is not tokenized, and one that fails to tokenize.
+        rows.append(['2017', '1', 'user{}'.format(author), '9', '0', 'a.java', 'a.java', 'class A {}'])
+        rows.append(['2017', '1', 'user{}'.format(author), '9', '0', 'bad.py', 'bad.py', 'def f(:\n'])
+    # An identical row appearing twice.
+    rows.append(list(rows[0]))
+    return rows
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for i, row in enumerate(rows):
+            writer.writerow([i] + row)
+    return str(path)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(converting, 'BATCH_SIZE', 3)
+
+
+def test_incremental_matches_full(tmp_path, small_batches):
+    rows = make_rows()
+    path_full = str(tmp_path / 'full.jsonl')
+    convert_files(write_csv(tmp_path / 'all.csv', rows), {'python': path_full})
+
+    # Build from a prefix of the input, leave a torn line behind, then resume.
+    path_out = str(tmp_path / 'incremental.jsonl')
+    convert_files(write_csv(tmp_path / 'part.csv', rows[:11]), {'python': path_out}, incremental=True)
+    with open(path_out, 'a') as f:
+        f.write('{"year": "2017", "user')
+    skipped, outputs = convert_files(write_csv(tmp_path / 'all.csv', rows), {'python': path_out},
+                                     incremental=True)
+
+    assert outputs['python'].resumed > 0
+    assert read_bytes(path_out) == read_bytes(path_full)
+
+    # Nothing left to do.
+    skipped, outputs = convert_files(str(tmp_path / 'all.csv'), {'python': path_out}, incremental=True)
+    assert outputs['python'].success == 0
+    assert read_bytes(path_out) == read_bytes(path_full)
+
+
+def test_incremental_refuses_corpus_without_manifest(tmp_path):
+    path_in = write_csv(tmp_path / 'all.csv', make_rows())
+    path_out = str(tmp_path / 'full.jsonl')
+    convert_files(path_in, {'python': path_out})
+    expected = read_bytes(path_out)
+
+    with pytest.raises(ValueError):
+        convert_files(path_in, {'python': path_out}, incremental=True)
+    assert read_bytes(path_out) == expected
+
+
+def test_incremental_fails_on_changed_row(tmp_path):
+    rows = make_rows()
+    path_out = str(tmp_path / 'incremental.jsonl')
+    convert_files(write_csv(tmp_path / 'all.csv', rows), {'python': path_out}, incremental=True)
+    expected = read_bytes(path_out)
+
+    rows[2][-1] = 'x = 1\n'
+    with pytest.raises(ValueError):
+        convert_files(write_csv(tmp_path / 'all.csv', rows), {'python': path_out}, incremental=True)
+    assert read_bytes(path_out) == expected
+    assert os.path.exists(path_out + '.manifest')
+
+
+def test_incremental_compressed(tmp_path, small_batches):
+    rows = make_rows()
+    path_full = str(tmp_path / 'full.jsonl')
+    convert_files(write_csv(tmp_path / 'all.csv', rows), {'python': path_full})
+
+    path_out = str(tmp_path / 'incremental.jsonl.gz')
+    convert_files(write_csv(tmp_path / 'part.csv', rows[:11]), {'python': path_out}, incremental=True)
+    convert_files(write_csv(tmp_path / 'all.csv', rows), {'python': path_out}, incremental=True)
+
+    with open_file(path_out) as f:
+        assert f.read() == read_bytes(path_full).decode('utf-8')
@@ -0,0 +1,78 @@
+import json
+import os
+
+import pytest
+
+from codeauthorship.dataset.corpus import CorpusWriter, TokenCorpus, is_corpus, iter_columns, iter_records
+from codeauthorship.dataset.corpus import read_jsonl, read_jsonl_pipelined
+from codeauthorship.dataset.reading import TokenProjection
+
+
+def test_corpus_records_match_jsonl(jsonl_path, corpus_path):
+    assert list(iter_records(corpus_path)) == list(iter_records(jsonl_path))
+
+
+@pytest.mark.parametrize('keep_types', [None, {'NAME'}, {'OP', 'STRING'}])
+def test_columns_match_records(records, jsonl_path, corpus_path, keep_types):
+    expected = []
+    for ex in records:
+        tokens = [x for x in ex['tokens'] if keep_types is None or x['type'] in keep_types]
+        expected.append((ex['username'], ex['example_id'], [x['type'] for x in tokens], [x['val'] for x in tokens]))
+
+    for path in (jsonl_path, corpus_path):
+        actual = [(ex['username'], ex['example_id'], ex['types'], ex['vals'])
+                  for ex in iter_columns(path, keep_types)]
+        assert actual == expected
+
+
+def test_corpus_lengths(records, corpus_path):
+    corpus = TokenCorpus(corpus_path)
+    assert len(corpus) == len(records)
+    assert corpus.lengths().tolist() == [len(ex['tokens']) for ex in records]
+
+
+def test_interrupted_write_is_not_a_corpus(tmp_path, records):
+    path = str(tmp_path / 'broken.corpus')
+    with pytest.raises(RuntimeError):
+        with CorpusWriter(path) as writer:
+            for i, ex in enumerate(records):
+                if i == 10:
+                    raise RuntimeError('interrupted')
+                writer.add(ex)
+    assert not is_corpus(path)
+
+
+def test_rewrite_invalidates_existing_corpus(tmp_path, records):
+    path = str(tmp_path / 'small.corpus')
+    with CorpusWriter(path) as writer:
+        for ex in records:
+            writer.add(ex)
+    assert is_corpus(path)
+
+    with pytest.raises(RuntimeError):
+        with CorpusWriter(path) as writer:
+            writer.add(records[0])
+            raise RuntimeError('interrupted')
+    assert not is_corpus(path)
+
+    with CorpusWriter(path) as writer:
+        writer.add(records[1])
+    with open(os.path.join(path, 'meta.json')) as f:
+        assert json.load(f)['n_files'] == 1
+
+
+@pytest.mark.parametrize('projection', [None, TokenProjection(include_type=['NAME'], lowercase=True)])
+@pytest.mark.parametrize('chunk_size', [1, 5, 64])
+def test_pipelined_matches_sequential(jsonl_path, projection, chunk_size):
+    expected = list(read_jsonl(jsonl_path, projection))
+    if projection is not None:
+        # Projected empty records are dropped by the workers.
+        expected = [ex for ex in expected if not ex['empty']]
+    actual = list(read_jsonl_pipelined(jsonl_path, projection, workers=2, chunk_size=chunk_size, max_in_flight=16))
+    assert actual == expected
+
+
+def test_pipelined_stops_early(jsonl_path):
+    records = read_jsonl_pipelined(jsonl_path, workers=2, chunk_size=4, max_in_flight=8)
+    assert next(records) == next(read_jsonl(jsonl_path))
+    records.close()
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from sklearn.ensemble import RandomForestClassifier
+
+from codeauthorship.scripts.train_multilang import run_evaluation
+
+
+def old_evaluation(model, X, Y, k=10):
+    # model.predict for the accuracy, and an argsort over the classes for top-k.
+    acc = np.mean(model.predict(X) == Y)
+
+    class2idx = {k: i for i, k in enumerate(model.classes_.tolist())}
+    y_idx = np.array([class2idx[k] for k in Y.tolist()]).repeat(k).reshape(-1, k)
+    prob = model.predict_proba(X)
+    pred = np.argsort(prob, axis=1)[:, ::-1][:, :k]
+    acck = {}
+    for kk in range(1, k+1):
+        acck[kk] = np.sum(pred[:, :kk] == y_idx[:, :kk], axis=1).mean()
+    return acc, acck
+
+
+@pytest.fixture
+def model_data():
+    rng = np.random.RandomState(0)
+    X = rng.rand(300, 8)
+    Y = rng.randint(0, 15, size=300) * 3
+    # Few shallow trees, so that many classes tie.
+    model = RandomForestClassifier(n_estimators=3, max_depth=3, random_state=0).fit(X[:200], Y[:200])
+    return model, X[200:], Y[200:]
+
+
+@pytest.mark.parametrize('max_buffer', [1 << 22, 40])
+def test_legacy_topk_matches_old(model_data, max_buffer):
+    model, X, Y = model_data
+    acc, acck = old_evaluation(model, X, Y)
+    results = run_evaluation(model, X, Y, max_buffer=max_buffer, legacy_topk=True)
+    assert results['acc'] == acc
+    assert results['acck'] == acck
+
+
+def test_topk_breaks_ties_like_predict(model_data):
+    model, X, Y = model_data
+    acc, acck = old_evaluation(model, X, Y)
+    results = run_evaluation(model, X, Y, max_buffer=40)
+    assert results['acc'] == acc
+    assert results['acck'][1] == acc
+    assert all(results['acck'][k] <= results['acck'][k+1] for k in range(1, 10))
+
+
+def test_k_is_capped(model_data):
+    model, X, Y = model_data
+    for legacy_topk in (False, True):
+        results = run_evaluation(model, X, Y, k=100, legacy_topk=legacy_topk)
+        assert sorted(results['acck']) == list(range(1, len(model.classes_) + 1))
+        assert results['acck'][len(model.classes_)] == 1.0
+
+
+def test_unseen_labels(model_data):
+    model, X, Y = model_data
+    with pytest.raises(ValueError):
+        run_evaluation(model, X, Y + 1)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from codeauthorship.dataset.encoding import SequenceBuilder, Vocab
+from codeauthorship.dataset.featurizing import FeatureStore, TokenTfidfVectorizer
+
+
+def encode(records):
+    vocab = Vocab()
+    builder = SequenceBuilder(vocab, Vocab())
+    for ex in records:
+        builder.add([x['val'] for x in ex['tokens']], [x['type'] for x in ex['tokens']])
+    return vocab, builder.build()
+
+
+def assert_same(X, Y):
+    assert X.shape == Y.shape
+    assert (X.indptr == Y.indptr).all()
+    assert (X.indices == Y.indices).all()
+    assert (X.data == Y.data).all()
+
+
+@pytest.mark.parametrize('max_features', [None, 5, 1000])
+def test_tfidf_matches_sklearn(records, max_features):
+    vocab, seqs = encode(records)
+    vectorizer = TokenTfidfVectorizer(vocab, max_features=max_features)
+    X = vectorizer.fit_transform(seqs)
+
+    expected = TfidfVectorizer(max_features=max_features)
+    Y = expected.fit_transform([' '.join(x['val'] for x in ex['tokens']) for ex in records])
+    assert vectorizer.vocabulary_ == expected.vocabulary_
+    assert_same(X, Y)
+
+
+@pytest.mark.parametrize('max_features', [None, 5])
+def test_exact_tfidf_matches_sklearn(records, max_features):
+    vocab, seqs = encode(records)
+    vectorizer = TokenTfidfVectorizer(vocab, max_features=max_features, exact=True)
+    X = vectorizer.fit_transform(seqs)
+
+    expected = TfidfVectorizer(analyzer=lambda x: x, max_features=max_features)
+    Y = expected.fit_transform([[x['val'] for x in ex['tokens']] for ex in records])
+    assert vectorizer.vocabulary_ == expected.vocabulary_
+    assert_same(X, Y)
+
+
+@pytest.mark.parametrize('exact', [False, True])
+def test_chunked_and_memmapped(tmp_path, records, exact):
+    vocab, seqs = encode(records)
+    X = TokenTfidfVectorizer(vocab, max_features=20, exact=exact).fit_transform(seqs)
+    chunked = TokenTfidfVectorizer(vocab, max_features=20, exact=exact, chunk_size=7,
+                                   out_dir=str(tmp_path)).fit_transform(seqs)
+    assert_same(chunked, X)
+
+
+def test_feature_store(tmp_path):
+    rng = np.random.RandomState(0)
+    X = sparse.random(50, 20, density=0.3, format='csr', random_state=rng)
+    index = np.sort(rng.choice(50, 30, replace=False))
+
+    store = FeatureStore(X)
+    arrays = {}
+    store.save(arrays)
+    for name, x in arrays.items():
+        np.save(str(tmp_path / '{}.npy'.format(name)), x)
+    # Workers open the arrays read-only.
+    loaded = FeatureStore.load({name: np.load(str(tmp_path / '{}.npy'.format(name)), mmap_mode='r')
+                                for name in arrays})
+
+    expected = X.astype(np.float32)[index]
+    for x in (store, loaded):
+        assert x.train(index).format == 'csc'
+        assert x.test(index).format == 'csr'
+        assert (x.train(index) != expected).nnz == 0
+        assert (x.test(index) != expected).nnz == 0
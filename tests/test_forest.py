@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from numpy.testing import assert_allclose
+from scipy import sparse
+from sklearn.ensemble import RandomForestClassifier
+
+from codeauthorship.models.forest import FlatForest
+from codeauthorship.scripts.train_multilang import run_evaluation, run_evaluation_flat
+
+
+def make_data(seed=0, n_rows=300, n_features=40, n_classes=12):
+    rng = np.random.RandomState(seed)
+    X = sparse.random(n_rows, n_features, density=0.2, format='csr', random_state=rng, dtype=np.float32)
+    Y = rng.randint(0, n_classes, size=n_rows) * 2 + 1
+    return X[:200], Y[:200], X[200:], Y[200:]
+
+
+def fit(X, Y, n_jobs=1, **kwargs):
+    return RandomForestClassifier(n_estimators=15, n_jobs=n_jobs, random_state=0, **kwargs).fit(X, Y)
+
+
+def expected_topk(model, X, k):
+    # Most probable first, ties to the lower class index.
+    prob = model.predict_proba(X)
+    order = np.lexsort((np.broadcast_to(np.arange(prob.shape[1]), prob.shape), -prob), axis=1)[:, :k]
+    return model.classes_[order], np.take_along_axis(prob, order, axis=1)
+
+
+@pytest.mark.parametrize('kwargs', [dict(), dict(max_depth=3), dict(class_weight='balanced')])
+def test_matches_sklearn(kwargs):
+    trainX, trainY, testX, testY = make_data()
+    model = fit(trainX, trainY, **kwargs)
+    forest = FlatForest.from_sklearn(model)
+
+    roots = forest.roots[None, :]
+    assert (forest.apply(testX) - roots == model.apply(testX)).all()
+    assert (forest.predict(testX) == model.predict(testX)).all()
+
+    for k in (1, 5, 100):
+        top, proba = forest.predict_topk(testX, k=k, max_buffer=50)
+        expected_top, expected_proba = expected_topk(model, testX, k)
+        assert (top == expected_top).all()
+        assert (proba == expected_proba).all()
+
+
+def test_parallel_predict_proba():
+    trainX, trainY, testX, testY = make_data(seed=1)
+    model = fit(trainX, trainY, n_jobs=2)
+    top, proba = FlatForest.from_sklearn(model).predict_topk(testX, k=5)
+    expected_top, expected_proba = expected_topk(model, testX, 5)
+    assert_allclose(proba, expected_proba, rtol=1e-12)
+
+
+def test_weighted_count_leaves():
+    # Trees of older sklearn versions store weighted counts, not fractions.
+    trainX, trainY, testX, testY = make_data(seed=2)
+    model = fit(trainX, trainY)
+    estimators = []
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        counts = tree.value * tree.weighted_n_node_samples[:, None, None]
+        estimators.append(SimpleNamespace(tree_=SimpleNamespace(
+            children_left=tree.children_left, children_right=tree.children_right, feature=tree.feature,
+            threshold=tree.threshold, value=counts, node_count=tree.node_count)))
+    old = SimpleNamespace(n_outputs_=1, classes_=model.classes_, estimators_=estimators,
+                          n_features_in_=model.n_features_in_)
+
+    top, proba = FlatForest.from_sklearn(old).predict_topk(testX, k=5)
+    expected_top, expected_proba = FlatForest.from_sklearn(model).predict_topk(testX, k=5)
+    assert_allclose(proba, expected_proba, rtol=1e-12)
+
+
+def test_save_load(tmp_path):
+    trainX, trainY, testX, testY = make_data(seed=3)
+    forest = FlatForest.from_sklearn(fit(trainX, trainY))
+    path = str(tmp_path / 'forest.npz')
+    forest.save(path)
+    loaded = FlatForest.load(path)
+    assert (loaded.apply(testX) == forest.apply(testX)).all()
+    assert (loaded.predict_topk(testX)[1] == forest.predict_topk(testX)[1]).all()
+
+
+def test_evaluation_matches():
+    trainX, trainY, testX, testY = make_data(seed=4)
+    model = fit(trainX, trainY, max_depth=4)
+    expected = run_evaluation(model, testX, testY)
+    actual = run_evaluation_flat(FlatForest.from_sklearn(model), testX, testY)
+    assert actual == expected
+
+    with pytest.raises(ValueError):
+        run_evaluation_flat(FlatForest.from_sklearn(model), testX, testY + 1)
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from codeauthorship.dataset.reading import DatasetReader, TokenProjection
+from codeauthorship.scripts.train_multilang import get_argument_parser
+
+
+OPTION_SETS = [
+    [],
+    ['--include_type', 'NAME,OP'],
+    ['--exclude_type', 'COMMENT,STRING'],
+    ['--reserved'],
+    ['--notreserved', '--extra_type'],
+    ['--author_usage', '4'],
+    ['--exclude_type', 'STRING', '--notreserved', '--author_usage', '2', '--extra_type'],
+    ]
+
+
+def get_options(*args):
+    return get_argument_parser().parse_args(list(args))
+
+
+def decode(datasets):
+    """
+    Datasets as plain lists of strings, so that the result of different
+    readers can be compared independently of the vocabulary order.
+    """
+    result = []
+    for dset in datasets:
+        seq = dset['primary']
+        vocab = dset['metadata']['vocab']
+        type_vocab = dset['metadata']['type_vocab']
+        result.append({
+            'vals': [[vocab[x] for x in seq[i].tolist()] for i in range(len(seq))],
+            'types': [[type_vocab[x] for x in seq.types(i).tolist()] for i in range(len(seq))],
+            'labels': dset['secondary']['labels'].tolist(),
+            'example_ids': dset['secondary']['example_ids'],
+            'label2idx': dset['metadata']['label2idx'],
+            })
+    return result
+
+
+@pytest.mark.parametrize('args', OPTION_SETS)
+def test_corpus_matches_jsonl(jsonl_path, corpus_path, args):
+    expected = decode(DatasetReader(get_options('--path_py', jsonl_path, *args)).read())
+    actual = decode(DatasetReader(get_options('--path_py', corpus_path, *args)).read())
+    assert actual == expected
+    assert len(expected[0]['vals']) > 0
+
+
+def test_multiple_languages(jsonl_path, corpus_path):
+    expected = decode(DatasetReader(get_options('--path_py', jsonl_path, '--path_c', jsonl_path)).read())
+    actual = decode(DatasetReader(get_options('--path_py', corpus_path, '--path_c', corpus_path)).read())
+    assert actual == expected
+
+
+PROJECTIONS = [
+    dict(),
+    dict(include_type=['NAME']),
+    dict(include_type=['NAME', 'STRING'], exclude_type=['STRING']),
+    dict(exclude_type=['COMMENT', 'NEWLINE'], lowercase=True),
+    dict(include_type=['NAME'], reserved=True),
+    dict(exclude_type=['OP'], notreserved=True, lowercase=True),
+    dict(include_type=['MISSING']),
+    ]
+
+
+@pytest.mark.parametrize('kwargs', PROJECTIONS)
+def test_parse_line_matches_json(jsonl_path, kwargs):
+    projection = TokenProjection(**kwargs)
+    with open(jsonl_path) as f:
+        for line in f:
+            assert projection.parse_line(line) == projection.project_record(json.loads(line))
+
+
+def test_parse_line_other_layout():
+    projection = TokenProjection(include_type=['NAME'])
+    line = '{"tokens": [{"val": "x", "type": "NAME"}, {"val": "+", "type": "OP"}], "username": "a"}\n'
+    assert projection.parse_line(line) == projection.project_record(json.loads(line))
+
+
+def test_concurrent_matches_sequential(jsonl_path, corpus_path):
+    args = ['--path_py', jsonl_path, '--path_c', corpus_path, '--path_cpp', jsonl_path, '--notreserved']
+    expected = DatasetReader(get_options('--read_jobs', '1', *args)).read()
+    actual = DatasetReader(get_options('--read_jobs', '3', *args)).read()
+    assert decode(actual) == decode(expected)
+    for x, y in zip(actual, expected):
+        assert (x['primary'].token_ids == y['primary'].token_ids).all()
+        assert (x['primary'].type_ids == y['primary'].type_ids).all()
+
+
+def test_pipelined_reader(jsonl_path):
+    args = ['--path_py', jsonl_path, '--read_jobs', '1', '--include_type', 'NAME,OP']
+    expected = DatasetReader(get_options(*args)).read()
+    actual = DatasetReader(get_options('--parse_jobs', '3', *args)).read()
+    assert decode(actual) == decode(expected)
@@ -0,0 +1,79 @@
+import random
+
+import numpy as np
+import pytest
+
+from codeauthorship.dataset.sampling import LabelGroups, balanced_sample
+
+
+def make_labels(seed=0, n_labels=40, n_files=400):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, n_labels, size=n_files)
+    languages = [['py', 'c', 'cpp'][x] for x in rng.randint(0, 3, size=n_files)]
+    # Some single-language labels.
+    for i in np.flatnonzero(labels % 5 == 0).tolist():
+        languages[i] = 'py'
+    return labels, languages
+
+
+def old_sample(Y, cutoff):
+    # The per-label loop balanced_sample replaces.
+    index = np.arange(Y.shape[0])
+    index_to_keep = []
+    for label in sorted(set(Y.tolist())):
+        mask = Y == label
+        if mask.sum() < cutoff:
+            continue
+        index_to_keep += index[mask].tolist()[:cutoff]
+    return np.array(index_to_keep, dtype=np.int64)
+
+
+def old_balance(Y, languages, label_lst, files_per_author, exact, multilang, max_classes):
+    # The loop DatasetManager.balance_data used before LabelGroups.
+    index = np.arange(len(Y))
+    index_to_keep = []
+    for label in label_lst:
+        mask = Y == label
+        if exact:
+            if mask.sum() != files_per_author:
+                continue
+        else:
+            if mask.sum() < files_per_author:
+                continue
+        if multilang:
+            subindex = index[mask].tolist()
+            if len(set(languages[idx] for idx in subindex)) == 1:
+                continue
+        index_to_keep += index[mask].tolist()[:files_per_author]
+    if max_classes is not None:
+        index_to_keep = index_to_keep[:max_classes*files_per_author]
+    return np.array(index_to_keep, dtype=np.int64)
+
+
+@pytest.mark.parametrize('cutoff', [1, 9, 12, 100])
+def test_balanced_sample_matches_loop(cutoff):
+    labels, _ = make_labels()
+    assert balanced_sample(labels, cutoff).tolist() == old_sample(labels, cutoff).tolist()
+
+
+@pytest.mark.parametrize('exact', [False, True])
+@pytest.mark.parametrize('multilang', [False, True])
+@pytest.mark.parametrize('max_classes', [None, 3])
+def test_shuffled_selection_matches_loop(exact, multilang, max_classes):
+    labels, languages = make_labels()
+    cutoff = 10
+    label_lst = list(set(labels.tolist()))
+    random.Random(0).shuffle(label_lst)
+
+    expected = old_balance(labels, languages, label_lst, cutoff, exact, multilang, max_classes)
+    actual = balanced_sample(labels, cutoff, exact=exact, languages=languages if multilang else None,
+                             label_order=label_lst, max_classes=max_classes)
+    assert len(expected) > 0
+    assert actual.tolist() == expected.tolist()
+
+
+def test_string_labels():
+    labels = np.array(['b', 'a', 'b', 'c', 'a', 'b'])
+    groups = LabelGroups(labels)
+    assert groups.labels.tolist() == ['a', 'b', 'c']
+    assert groups.take(groups.find(['b', 'a']), 2).tolist() == [0, 2, 1, 4]